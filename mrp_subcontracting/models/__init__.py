@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from . import mrp_bom
+from . import mrp_production
 from . import product
 from . import res_company
 from . import res_partner
@@ -1,23 +1,135 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
-from odoo import api, fields, models
+from collections import defaultdict
+
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError
 from odoo.osv.expression import AND
+from odoo.tools.cache import STAT
+
+
+# fields of the BoM lookups cached by _bom_find_id and _bom_subcontract_find_id
+BOM_LOOKUP_FIELDS = {
+    'product_id', 'product_tmpl_id', 'type', 'company_id', 'picking_type_id',
+    'sequence', 'active', 'subcontractor_ids',
+}
+
 
 class MrpBom(models.Model):
     _inherit = 'mrp.bom'
 
     type = fields.Selection(selection_add=[('subcontract', 'Subcontracting')])
     subcontractor_ids = fields.Many2many('res.partner', 'mrp_bom_subcontractor', string='Subcontractors', check_company=True)
+    # inverse of res.partner subcontract_bom_ids: the subcontractors and all their children
+    subcontract_partner_ids = fields.Many2many(
+        'res.partner', 'mrp_bom_subcontract_partner_rel', 'bom_id', 'partner_id',
+        string='Eligible Subcontractor Contacts', readonly=True, copy=False)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        boms = super(MrpBom, self).create(vals_list)
+        boms.mapped('subcontractor_ids')._update_subcontract_bom_ids()
+        self.clear_caches()
+        return boms
+
+    def write(self, vals):
+        if 'subcontractor_ids' in vals:
+            subcontractors = self.mapped('subcontractor_ids')
+        res = super(MrpBom, self).write(vals)
+        if 'subcontractor_ids' in vals:
+            (subcontractors | self.mapped('subcontractor_ids'))._update_subcontract_bom_ids()
+        if BOM_LOOKUP_FIELDS.intersection(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(MrpBom, self).unlink()
+        self.clear_caches()
+        return res
 
     def _bom_subcontract_find(self, product_tmpl=None, product=None, picking_type=None, company_id=False, bom_type='subcontract', subcontractor=False):
-        domain = self._bom_find_domain(product_tmpl=product_tmpl, product=product, picking_type=picking_type, company_id=company_id, bom_type=bom_type)
         if subcontractor:
-            domain = AND([domain, [('subcontractor_ids', 'parent_of', subcontractor.ids)]])
-            return self.search(domain, order='sequence, product_id', limit=1)
+            bom_id = self._bom_subcontract_find_id(
+                product_tmpl.id if product_tmpl else False,
+                product.id if product else False,
+                picking_type.id if picking_type else False,
+                company_id or self.env.context.get('company_id'),
+                bom_type,
+                tuple(subcontractor.ids),
+            )
+            return self.browse(bom_id)
         else:
             return self.env['mrp.bom']
 
+    @tools.ormcache('self.env.uid', 'product_tmpl_id', 'product_id', 'picking_type_id', 'company_id', 'bom_type', 'subcontractor_ids')
+    def _bom_subcontract_find_id(self, product_tmpl_id, product_id, picking_type_id, company_id, bom_type, subcontractor_ids):
+        """ Cached lookup of _bom_subcontract_find, working on ids. The cache
+        is cleared by any change on mrp.bom and on the partners hierarchy.
+        """
+        domain = self._bom_find_domain(
+            product_tmpl=self.env['product.template'].browse(product_tmpl_id),
+            product=self.env['product.product'].browse(product_id),
+            picking_type=self.env['stock.picking.type'].browse(picking_type_id),
+            company_id=company_id,
+            bom_type=bom_type,
+        )
+        domain = AND([domain, [('subcontract_partner_ids', 'in', list(subcontractor_ids))]])
+        # the cache is shared by all the callers, whatever their active_test
+        return self.with_context(active_test=True).search(domain, order='sequence, product_id', limit=1).id
+
+    def _bom_subcontract_find_batch(self, keys, bom_type='subcontract'):
+        """ Batched version of _bom_subcontract_find. All the candidate BoMs of
+        the given keys are fetched with a single search, then each key takes the
+        first one that _bom_subcontract_find would have matched.
+
+        :param keys: iterable of (product, picking_type, company_id, subcontractor)
+        :return: dict mapping each key to its subcontracting BoM (may be empty)
+        """
+        keys = set(keys)
+        result = dict.fromkeys(keys, self.env['mrp.bom'])
+        keys = [key for key in keys if key[0] and key[3]]
+        if not keys:
+            return result
+        products = self.env['product.product'].concat(*[key[0] for key in keys])
+        subcontractors = self.env['res.partner'].concat(*[key[3] for key in keys])
+        domain = [
+            '|', ('product_id', 'in', products.ids),
+            '&', ('product_id', '=', False), ('product_tmpl_id', 'in', products.mapped('product_tmpl_id').ids),
+            ('type', '=', bom_type),
+            ('subcontract_partner_ids', 'in', subcontractors.ids),
+        ]
+        boms = self.search(domain, order='sequence, product_id')
+        # candidates per variant and per template (variant-less BoMs), each
+        # bucket keeping the search order
+        boms_per_product = defaultdict(list)
+        boms_per_template = defaultdict(list)
+        for index, bom in enumerate(boms):
+            if bom.product_id:
+                boms_per_product[bom.product_id.id].append((index, bom))
+            else:
+                boms_per_template[bom.product_tmpl_id.id].append((index, bom))
+        eligible_bom_ids = {partner.id: set(partner.subcontract_bom_ids.ids) for partner in subcontractors}
+        context_company_id = self.env.context.get('company_id')
+        for key in keys:
+            product, picking_type, company_id, subcontractor = key
+            company_id = company_id or context_company_id
+            bom_ids = set().union(*[eligible_bom_ids[partner_id] for partner_id in subcontractor.ids])
+            candidates = sorted(
+                boms_per_product[product.id] + boms_per_template[product.product_tmpl_id.id],
+                key=lambda candidate: candidate[0],
+            )
+            for dummy, bom in candidates:
+                if picking_type and bom.picking_type_id and bom.picking_type_id != picking_type:
+                    continue
+                if company_id and bom.company_id and bom.company_id.id != company_id:
+                    continue
+                if bom.id not in bom_ids:
+                    continue
+                result[key] = bom
+                break
+        return result
+
     @api.model
     def _bom_find_domain(self, product_tmpl=None, product=None, picking_type=None, company_id=False, bom_type=False):
         if product:
@@ -45,7 +157,38 @@ class MrpBom(models.Model):
         """ Finds BoM for particular product, picking and company """
         if product and product.type == 'service' or product_tmpl and product_tmpl.type == 'service' or not product:
             return self  # returning False will make bom.type fail in mrp_bom.explode (fixed in v13)
-        domain = self._bom_find_domain(product_tmpl=product_tmpl, product=product, picking_type=picking_type, company_id=company_id, bom_type=bom_type)
-        if domain is False:
-            return domain
-        return self.search(domain, order='sequence, product_id', limit=1)
+        bom_id = self._bom_find_id(
+            product_tmpl.id if product_tmpl else False,
+            product.id,
+            picking_type.id if picking_type else False,
+            company_id or self.env.context.get('company_id'),
+            bom_type,
+        )
+        return self.browse(bom_id)
+
+    @tools.ormcache('self.env.uid', 'product_tmpl_id', 'product_id', 'picking_type_id', 'company_id', 'bom_type')
+    def _bom_find_id(self, product_tmpl_id, product_id, picking_type_id, company_id, bom_type):
+        """ Cached lookup of _bom_find, working on ids. """
+        domain = self._bom_find_domain(
+            product_tmpl=self.env['product.template'].browse(product_tmpl_id),
+            product=self.env['product.product'].browse(product_id),
+            picking_type=self.env['stock.picking.type'].browse(picking_type_id),
+            company_id=company_id,
+            bom_type=bom_type,
+        )
+        # the cache is shared by all the callers, whatever their active_test
+        return self.with_context(active_test=True).search(domain, order='sequence, product_id', limit=1).id
+
+    @api.model
+    def _get_bom_find_cache_stats(self):
+        """ Return the hit and miss counters of the BoM lookup caches for the
+        current database, as counted by ormcache.
+        """
+        stats = {'hit': 0, 'miss': 0}
+        for (db_name, model_name, method), counter in list(STAT.items()):
+            if db_name != self.pool.db_name or model_name != self._name:
+                continue
+            if method.__name__ in ('_bom_find_id', '_bom_subcontract_find_id'):
+                stats['hit'] += counter.hit
+                stats['miss'] += counter.miss
+        return stats
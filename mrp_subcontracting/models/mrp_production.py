@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo import api, fields, models
+from odoo.tools import pycompat
+
+# key of the messages to post in the cursor cache, see _group_tracking_messages
+TRACKING_MESSAGES_KEY = 'mrp_subcontracting.tracking_messages'
+TRACKING_TEMPLATE = 'mrp.track_production_move_template'
+
+
+class MrpProduction(models.Model):
+    _inherit = 'mrp.production'
+
+    has_tracked_components = fields.Boolean(
+        'Has Tracked Components', compute='_compute_has_tracked_components', store=True)
+
+    @api.depends('move_raw_ids.product_id.tracking')
+    def _compute_has_tracked_components(self):
+        for production in self:
+            production.has_tracked_components = any(m.has_tracking != 'none' for m in production.move_raw_ids)
+
+    def message_post_with_view(self, views_or_xmlid, **kwargs):
+        """ Within a _group_tracking_messages block, render the traceability
+        messages of the move lines now but keep them to be posted on exit.
+        """
+        messages = self.env.cr.cache.get(TRACKING_MESSAGES_KEY)
+        if messages is None or views_or_xmlid != TRACKING_TEMPLATE:
+            return super(MrpProduction, self).message_post_with_view(views_or_xmlid, **kwargs)
+        views = self.env.ref(views_or_xmlid, raise_if_not_found=False)
+        if not views:
+            return
+        values = dict(kwargs.get('values') or {})
+        for production in self:
+            values['object'] = production
+            messages[production.id].append((
+                pycompat.to_text(views.render(values, engine='ir.qweb')),
+                kwargs.get('subtype_id'),
+            ))
+
+    @contextmanager
+    def _group_tracking_messages(self):
+        """ Within the block, the traceability messages of the move lines
+        (one per done move line written) are collected, then posted as one
+        message per production on exit. Nested blocks are posted by the
+        outermost one. Nothing is posted if the block raises.
+        """
+        cache = self.env.cr.cache
+        if TRACKING_MESSAGES_KEY in cache:
+            yield
+            return
+        cache[TRACKING_MESSAGES_KEY] = defaultdict(list)
+        try:
+            yield
+        finally:
+            messages = cache.pop(TRACKING_MESSAGES_KEY)
+        for production in self.browse(sorted(messages)).exists():
+            bodies = messages[production.id]
+            production.message_post(
+                body=''.join(body for body, subtype_id in bodies),
+                subtype_id=bodies[0][1],
+            )
+
+    def _get_subcontract_resupply_moves(self):
+        """ Return the moves resupplying the components of the productions of
+        self, fetched with a single search.
+
+        :return: dict mapping each production to its resupply moves
+        """
+        moves_per_production = defaultdict(lambda: self.env['stock.move'])
+        raw_moves = self.mapped('move_raw_ids')
+        if not raw_moves:
+            return moves_per_production
+        resupply_moves = self.env['stock.move'].search([('move_dest_ids', 'in', raw_moves.ids)])
+        for move in resupply_moves:
+            for production in move.move_dest_ids.mapped('raw_material_production_id') & self:
+                moves_per_production[production] |= move
+        return moves_per_production
+
+    def _cancel_subcontract_resupply(self):
+        """ Cancel the moves resupplying the components of the productions of
+        self at once, before the productions are cancelled. The other moves
+        of their pickings, and the moves also resupplying other productions,
+        are kept.
+        """
+        resupply_moves = self.env['stock.move'].concat(*self._get_subcontract_resupply_moves().values())
+        resupply_moves.filtered(
+            lambda m: m.state not in ('done', 'cancel') and
+            not m.move_dest_ids.mapped('raw_material_production_id') - self
+        )._action_cancel()
@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from collections import defaultdict
+
 from odoo import api, fields, models
 
 
 class SupplierInfo(models.Model):
     _inherit = 'product.supplierinfo'
 
-    is_subcontractor = fields.Boolean('Subcontracted', compute='_compute_is_subcontractor', help="Choose a vendor of type subcontractor if you want to subcontract the product")
+    is_subcontractor = fields.Boolean(
+        'Subcontracted', compute='_compute_is_subcontractor', store=True, index=True,
+        help="Choose a vendor of type subcontractor if you want to subcontract the product")
 
-    @api.depends('name', 'product_id', 'product_tmpl_id')
+    @api.depends('name', 'product_id', 'product_tmpl_id',
+                 'product_tmpl_id.bom_ids.type', 'product_tmpl_id.bom_ids.product_id',
+                 'product_tmpl_id.bom_ids.subcontractor_ids', 'product_tmpl_id.bom_ids.active')
     def _compute_is_subcontractor(self):
+        # read the subcontracting BoMs of all the templates at once
+        boms_per_template = defaultdict(lambda: self.env['mrp.bom'])
+        for bom in self.mapped('product_tmpl_id.bom_ids'):
+            if bom.type == 'subcontract':
+                boms_per_template[bom.product_tmpl_id] |= bom
         for supplier in self:
-            if supplier.product_id.variant_bom_ids:
-                boms = supplier.product_id.variant_bom_ids
-                boms |= supplier.product_tmpl_id.bom_ids.filtered(lambda b: not b.product_id and b.type == 'subcontract')
-                supplier.is_subcontractor = supplier.name in boms.subcontractor_ids.filtered(lambda b: b.type == 'subcontract')
-
+            # a vendor line of the whole template only relies on the BoMs of
+            # the whole template, not on the ones of a single variant
+            boms = boms_per_template[supplier.product_tmpl_id].filtered(
+                lambda b: not b.product_id or b.product_id == supplier.product_id
+            )
+            supplier.is_subcontractor = supplier.name in boms.mapped('subcontractor_ids')
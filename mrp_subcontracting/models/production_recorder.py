@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from odoo import _
+from odoo.exceptions import UserError
+from odoo.osv.expression import AND, OR
+from odoo.tools.float_utils import float_compare, float_is_zero, float_round
+
+
+class ProduceLine(object):
+    """ In memory counterpart of a mrp.product.produce.line """
+
+    __slots__ = ('move', 'product', 'product_uom', 'lot', 'qty_to_consume', 'qty_reserved', 'qty_done')
+
+    def __init__(self, move, product, product_uom, lot, qty_to_consume=0.0, qty_reserved=0.0, qty_done=0.0):
+        self.move = move
+        self.product = product
+        self.product_uom = product_uom
+        self.lot = lot
+        self.qty_to_consume = qty_to_consume
+        self.qty_reserved = qty_reserved
+        self.qty_done = qty_done
+
+    @classmethod
+    def from_record(cls, line):
+        return cls(line.move_id, line.product_id, line.product_uom_id, line.lot_id,
+                   qty_to_consume=line.qty_to_consume, qty_reserved=line.qty_reserved, qty_done=line.qty_done)
+
+    def _expand_serial_range(self):
+        """ Split a range of serial numbers to enter (serial tracked line
+        without lot) into a line per unit.
+        """
+        if self.lot or self.product.tracking != 'serial' or self.qty_to_consume <= 1:
+            return [self]
+        return [
+            ProduceLine(self.move, self.product, self.product_uom, self.lot, qty_to_consume=1, qty_done=1)
+            for dummy in range(int(self.qty_to_consume))
+        ]
+
+    def _get_values(self):
+        """ Values to create the mrp.product.produce.line of the line """
+        return {
+            'move_id': self.move.id,
+            'product_id': self.product.id,
+            'product_uom_id': self.product_uom.id,
+            'lot_id': self.lot.id,
+            'qty_to_consume': self.qty_to_consume,
+            'qty_reserved': self.qty_reserved,
+            'qty_done': self.qty_done,
+        }
+
+
+class ProductionRecorder(object):
+    """ Record a production of a manufacturing order without the
+    mrp.product.produce wizard: the components and by-products to process are
+    planned in memory (ProduceLine), then saved on the stock move lines.
+
+    Server side flows use it directly, the wizard is a frontend over it.
+    """
+
+    def __init__(self, production, product_qty, product_uom, finished_lot=None, subcontract_move=None, consumption=False, uom_factors=None):
+        self.env = production.env
+        self.production = production
+        self.product = production.product_id
+        self.product_qty = product_qty  # qty_producing in v13
+        self.product_uom = product_uom
+        self.finished_lot = finished_lot or self.env['stock.production.lot']
+        self.subcontract_move = subcontract_move or self.env['stock.move']
+        self.consumption = consumption
+        # {(from uom id, to uom id): (from factor, to factor, to rounding)}
+        self.uom_factors = uom_factors if uom_factors is not None else {}
+        self.raw_lines = []
+        self.finished_lines = []
+        self._planned_qty_to_consume = {}
+        # move line splits and updates queued by _update_move_lines
+        self._pending_move_line_copies = []
+        self._pending_move_line_writes = {}
+        self._pending_consumed_lot_ids = defaultdict(set)
+
+    def _get_lines(self):
+        return self.raw_lines + self.finished_lines
+
+    def _add_lines(self, move, lines):
+        if move in self.production.move_raw_ids:
+            self.raw_lines += lines
+        else:
+            self.finished_lines += lines
+
+    # -------------------------------------------------------------------------
+    # Planning
+    # -------------------------------------------------------------------------
+
+    def generate_lines(self):
+        """ Plan the components and by-products to process for the produced
+        quantity, as the wizard onchange does.
+
+        :return: the new raw lines and the new finished lines
+        """
+        raw_line_count = len(self.raw_lines)
+        finished_line_count = len(self.finished_lines)
+        # quantity to consume already planned per (move, lot), updated once the
+        # lines of a move are generated
+        self._planned_qty_to_consume = {}
+        for line in self._get_lines():
+            self._plan_qty_to_consume(line)
+        moves = (self.production.move_raw_ids | self.production.move_finished_ids).filtered(
+            lambda move: move.state not in ('done', 'cancel')
+        )
+        for move in moves:
+            qty_to_consume = self._prepare_component_quantity(move, self.product_qty)
+            lines = self._generate_lines_values(move, qty_to_consume)
+            self._add_lines(move, lines)
+            for line in lines:
+                self._plan_qty_to_consume(line)
+        return self.raw_lines[raw_line_count:], self.finished_lines[finished_line_count:]
+
+    def _plan_qty_to_consume(self, line):
+        key = (line.move.id, line.lot.id)
+        self._planned_qty_to_consume[key] = self._planned_qty_to_consume.get(key, 0.0) + line.qty_to_consume
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _prepare_component_quantity(self, move, product_qty):
+        """ helper that computes quantity to consume (or to create in case of byproduct)
+        depending on the quantity producing and the move's unit factor"""
+        if move.product_id.tracking == 'serial':
+            uom = move.product_id.uom_id
+        else:
+            uom = move.product_uom
+        return move.product_uom._compute_quantity(
+            product_qty * move.unit_factor,
+            uom,
+            round=False
+        )
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _generate_lines_values(self, move, qty_to_consume):
+        """ Create workorder line. First generate line based on the reservation,
+        in order to prefill reserved quantity, lot and serial number.
+        If the quantity to consume is greater than the reservation quantity then
+        create line with the correct quantity to consume but without lot or
+        serial number.
+        """
+        lines = []
+        is_tracked = move.product_id.tracking == 'serial'
+        for move_line in move.move_line_ids:
+            if float_compare(qty_to_consume, 0.0, precision_rounding=move.product_uom.rounding) <= 0:
+                break
+            # move line already 'used' in workorder (from its lot for instance)
+            if move_line.lot_produced_ids or float_compare(move_line.product_uom_qty, move_line.qty_done, precision_rounding=move.product_uom.rounding) <= 0:
+                continue
+            # search wo line on which the lot is not fully consumed or other reserved lot
+            linked_qty_to_consume = self._planned_qty_to_consume.get((move.id, move_line.lot_id.id))
+            if linked_qty_to_consume is not None:
+                if float_compare(linked_qty_to_consume, move_line.product_uom_qty - move_line.qty_done, precision_rounding=move.product_uom.rounding) < 0:
+                    to_consume_in_line = min(qty_to_consume, move_line.product_uom_qty - move_line.qty_done - linked_qty_to_consume)
+                else:
+                    continue
+            else:
+                to_consume_in_line = min(qty_to_consume, move_line.product_uom_qty - move_line.qty_done)
+            lines.append(ProduceLine(
+                move, move.product_id,
+                is_tracked and move.product_id.uom_id or move.product_uom,
+                move_line.lot_id,
+                qty_to_consume=to_consume_in_line,
+                qty_reserved=to_consume_in_line,
+                qty_done=to_consume_in_line,
+            ))
+            qty_to_consume -= to_consume_in_line
+        # The move has not reserved the whole quantity so we create new wo lines
+        if float_compare(qty_to_consume, 0.0, precision_rounding=move.product_uom.rounding) > 0:
+            if move.product_id.tracking == 'serial':
+                # one line for the whole range of serial numbers to enter,
+                # split as the serial numbers are entered, see
+                # _expand_serial_range
+                serial_count = math.ceil(float_round(qty_to_consume, precision_rounding=move.product_uom.rounding))
+                lines.append(ProduceLine(
+                    move, move.product_id, move.product_id.uom_id, self.env['stock.production.lot'],
+                    qty_to_consume=serial_count,
+                    qty_done=serial_count,
+                ))
+            else:
+                lines.append(ProduceLine(
+                    move, move.product_id, move.product_uom, self.env['stock.production.lot'],
+                    qty_to_consume=qty_to_consume,
+                    qty_done=qty_to_consume,
+                ))
+        return lines
+
+    # -------------------------------------------------------------------------
+    # Recording
+    # -------------------------------------------------------------------------
+
+    # method in v13 'mrp_product_produce' but not in v12
+    def record(self):
+        """ Save the planned lines into the stock moves and move lines. """
+        production = self.production
+        # Check all the lines have a move (the user can add product to consume
+        # directly in the wizard)
+        lines_without_move = defaultdict(list)
+        for lines, moves in ((self.raw_lines, production.move_raw_ids), (self.finished_lines, production.move_finished_ids)):
+            # Find move that would match
+            open_move_per_product = {}
+            for move in moves:
+                if move.state not in ('done', 'cancel'):
+                    open_move_per_product.setdefault(move.product_id, move)
+            for line in lines:
+                if line.move:
+                    continue
+                if line.product in open_move_per_product:
+                    line.move = open_move_per_product[line.product]
+                else:
+                    lines_without_move[lines is self.raw_lines, line.product].append(line)
+        if lines_without_move:
+            # create a move per product to assign it to the lines
+            keys = list(lines_without_move)
+            moves = self.env['stock.move'].create([
+                self._prepare_line_move_values(lines_without_move[key][0], is_raw=key[0])
+                for key in keys
+            ])
+            for key, move in zip(keys, moves):
+                for line in lines_without_move[key]:
+                    line.move = move
+
+        # Save product produce lines data into stock moves/move lines
+        if float_compare(self.product_qty, 0, precision_rounding=self.product_uom.rounding) <= 0:
+            raise UserError(_("The production order for '%s' has no quantity specified.") % self.product.display_name)
+        with self.env['stock.move']._defer_overprocessed_subcontract_check():
+            self._update_finished_move()
+            self._update_moves()
+        if production.state == 'confirmed':
+            production.write({
+                'date_start': datetime.now(),
+            })
+
+    def _prepare_line_move_values(self, line, is_raw):
+        production = self.production
+        if is_raw:
+            return {
+                'name': production.name,
+                'reference': production.name,
+                'product_id': line.product.id,
+                'product_uom': line.product_uom.id,
+                'location_id': production.location_src_id.id,
+                'location_dest_id': line.product.property_stock_production.id,
+                'raw_material_production_id': production.id,
+                'group_id': production.procurement_group_id.id,
+                'origin': production.name,
+                'state': 'confirmed',
+                'company_id': production.company_id.id,
+            }
+        return production._get_finished_move_value(line.product.id, 0, line.product_uom.id)
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _update_finished_move(self):
+        """ Update the finished move & move lines in order to set the finished
+        product lot on it as well as the produced quantity."""
+        production_move = self.production.move_finished_ids.filtered(
+            lambda move: move.product_id == self.product and
+            move.state not in ('done', 'cancel')
+        )
+        if production_move and production_move.product_id.tracking != 'none':
+            if not self.finished_lot:
+                raise UserError(_('You need to provide a lot for the finished product.'))
+            move_line = production_move.move_line_ids.filtered(
+                lambda line: line.lot_id.id == self.finished_lot.id
+            )
+            if move_line:
+                if self.product.tracking == 'serial':
+                    raise UserError(_('You cannot produce the same serial number twice.'))
+                move_line.product_uom_qty += self.product_qty
+                move_line.qty_done += self.product_qty
+            else:
+                location_dest_id = production_move.location_dest_id._get_putaway_strategy(self.product).id or production_move.location_dest_id.id
+                move_line.create({
+                    'move_id': production_move.id,
+                    'product_id': production_move.product_id.id,
+                    'lot_id': self.finished_lot.id,
+                    'product_uom_qty': self.product_qty,
+                    'product_uom_id': self.product_uom.id,
+                    'qty_done': self.product_qty,
+                    'location_id': production_move.location_id.id,
+                    'location_dest_id': location_dest_id,
+                })
+        # else:
+        #     production_move._set_quantity_done(
+        #         float_round(self.product_qty, precision_rounding=production_move.product_uom.rounding)
+        #     )
+
+        # Part of the '_update_finished_move method' in v13 'mrp_subcontracting'
+        """ After producing, set the move line on the subcontract picking. """
+        if self.subcontract_move:
+            self.env['stock.move.line'].create({
+                'move_id': self.subcontract_move.id,
+                'picking_id': self.subcontract_move.picking_id.id,
+                'product_id': self.product.id,
+                'location_id': self.subcontract_move.location_id.id,
+                'location_dest_id': self.subcontract_move.location_dest_id.id,
+                'product_uom_qty': 0,
+                'product_uom_id': self.product_uom.id,
+                'qty_done': self.product_qty,
+                'lot_id': self.finished_lot and self.finished_lot.id,
+            })
+            if not self.env['mrp.product.produce']._get_todo(self.production):
+                ml_reserved = self.subcontract_move.move_line_ids.filtered(lambda ml:
+                    float_is_zero(ml.qty_done, precision_rounding=ml.product_uom_id.rounding) and
+                    not float_is_zero(ml.product_uom_qty, precision_rounding=ml.product_uom_id.rounding))
+                ml_reserved.unlink()
+                for ml in self.subcontract_move.move_line_ids:
+                    ml.product_uom_qty = ml.qty_done
+                self.subcontract_move._recompute_state()
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _update_moves(self):
+        """ Once the production is done. Modify the workorder lines into
+        stock move line with the registered lot and quantity done.
+        """
+        # Before writting produce quantities, we ensure they respect the bom strictness
+        self._strict_consumption_check()
+        vals_list = []
+        lines_to_process = [line for line in self._get_lines() if line.product != self.product and line.qty_done > 0]
+        for line in lines_to_process:
+            self._update_move_lines(line)
+        self._flush_move_lines()
+        # the quantity left is consumed from the quants of all the lines, read at once
+        lines_to_extend = [
+            line for line in lines_to_process
+            if float_compare(line.qty_done, 0, precision_rounding=line.product_uom.rounding) > 0
+        ]
+        quants_per_key = self._gather_quants({(line.product, line.move.location_id, line.lot) for line in lines_to_extend})
+        for line in lines_to_extend:
+            vals_list += self._create_extra_move_lines(line, quants=quants_per_key[line.product, line.move.location_id, line.lot])
+
+        # the lines are now saved into the move lines
+        self.raw_lines = [line for line in self.raw_lines if line.product == self.product]
+        self.finished_lines = [line for line in self.finished_lines if line.product == self.product]
+        self.env['stock.move.line'].create(vals_list)
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _strict_consumption_check(self):
+        if self.consumption == 'strict':
+            lines_per_move = defaultdict(list)
+            for line in self._get_lines():
+                lines_per_move[line.move].append(line)
+            rounding = self.product_uom.rounding
+            for move in self.production.move_raw_ids:
+                lines = lines_per_move[move]
+                qty_done = 0.0
+                qty_to_consume = 0.0
+                for line in lines:
+                    qty_done += self._compute_uom_quantity(line.qty_done, line.product_uom, line.product.uom_id)
+                    qty_to_consume += self._compute_uom_quantity(line.qty_to_consume, line.product_uom, line.product.uom_id)
+                if float_compare(qty_done, qty_to_consume, precision_rounding=rounding) != 0:
+                    raise UserError(_('You should consume the quantity of %s defined in the BoM. If you want to consume more or less components, change the consumption setting on the BoM.') % lines[0].product.name)
+
+    def _compute_uom_quantity(self, qty, from_uom, to_uom):
+        """ from_uom._compute_quantity(qty, to_uom), with the factors read once
+        in the table shared by the engines of the transaction.
+        """
+        if not from_uom:
+            return qty
+        key = (from_uom.id, to_uom.id)
+        if key not in self.uom_factors:
+            if from_uom.category_id != to_uom.category_id:
+                self.uom_factors[key] = None
+            else:
+                self.uom_factors[key] = (from_uom.factor, to_uom.factor, to_uom.rounding)
+        factors = self.uom_factors[key]
+        if factors is None:
+            # let the uom raise its error
+            return from_uom._compute_quantity(qty, to_uom)
+        from_factor, to_factor, rounding = factors
+        return float_round(qty / from_factor * to_factor, precision_rounding=rounding, rounding_method='UP')
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _update_move_lines(self, line):
+        """ update a move line to save the workorder line data
+
+        The splits and updates of the move lines are queued, the next lines
+        reading the queued values, then applied by _flush_move_lines.
+        """
+        if line.lot:
+            move_lines = line.move.move_line_ids.filtered(lambda ml: ml.lot_id == line.lot and not self._get_move_line_value(ml, 'lot_produced_ids'))
+        else:
+            move_lines = line.move.move_line_ids.filtered(lambda ml: not ml.lot_id and not self._get_move_line_value(ml, 'lot_produced_ids'))
+
+        # Sanity check: if the product is a serial number and `lot` is already present in the other
+        # consumed move lines, raise.
+        if line.product.tracking != 'none' and not line.lot:
+            raise UserError(_('Please enter a lot or serial number for %s !') % line.product.display_name)
+
+        if line.lot and line.product.tracking == 'serial' and line.lot.id in self._get_consumed_lot_ids(line.move):
+            raise UserError(_('You cannot consume the same serial number twice. Please correct the serial numbers encoded.'))
+
+        # Update reservation and quantity done
+        for ml in move_lines:
+            rounding = ml.product_uom_id.rounding
+            if float_compare(line.qty_done, 0, precision_rounding=rounding) <= 0:
+                break
+            ml_qty_done = self._get_move_line_value(ml, 'qty_done')
+            ml_product_uom_qty = self._get_move_line_value(ml, 'product_uom_qty')
+            quantity_to_process = min(line.qty_done, ml_product_uom_qty - ml_qty_done)
+            line.qty_done -= quantity_to_process
+
+            new_quantity_done = (ml_qty_done + quantity_to_process)
+            # if we produce less than the reserved quantity to produce the finished products
+            # in different lots,
+            # we create different component_move_lines to record which one was used
+            # on which lot of finished product
+            if float_compare(new_quantity_done, ml_product_uom_qty, precision_rounding=rounding) >= 0:
+                self._pending_move_line_writes.setdefault(ml, {}).update({
+                    'qty_done': new_quantity_done,
+                    'lot_produced_ids': self._get_produced_lots(line),
+                })
+            else:
+                new_qty_reserved = ml_product_uom_qty - new_quantity_done
+                default = {
+                    'product_uom_qty': new_quantity_done,
+                    'qty_done': new_quantity_done,
+                    'lot_produced_ids': self._get_produced_lots(line),
+                }
+                self._pending_move_line_copies += ml.copy_data(default=default)
+                if new_quantity_done and ml.lot_id:
+                    self._pending_consumed_lot_ids[ml.move_id.id].add(ml.lot_id.id)
+                self._pending_move_line_writes.setdefault(ml, {}).update({
+                    'product_uom_qty': new_qty_reserved,
+                    'qty_done': 0
+                })
+
+    def _get_move_line_value(self, move_line, field_name):
+        """ Value of the field on the move line, including the queued updates """
+        vals = self._pending_move_line_writes.get(move_line)
+        if vals and field_name in vals:
+            return vals[field_name]
+        return move_line[field_name]
+
+    def _get_consumed_lot_ids(self, move):
+        """ Ids of the lots of the move lines with a quantity done, including
+        the queued splits and updates.
+        """
+        lot_ids = set(move.move_line_ids.filtered(lambda ml: self._get_move_line_value(ml, 'qty_done')).mapped('lot_id').ids)
+        return lot_ids | self._pending_consumed_lot_ids[move.id]
+
+    def _flush_move_lines(self):
+        """ Apply the move line splits queued by _update_move_lines with one
+        create, then write the move lines getting the same values together.
+        """
+        MoveLine = self.env['stock.move.line']
+        if self._pending_move_line_copies:
+            MoveLine.create(self._pending_move_line_copies)
+        move_lines_per_vals = {}
+        for move_line, vals in self._pending_move_line_writes.items():
+            key = tuple(sorted(
+                (field_name, tuple(value) if isinstance(value, list) else value)
+                for field_name, value in vals.items()
+            ))
+            if key not in move_lines_per_vals:
+                move_lines_per_vals[key] = (vals, MoveLine)
+            move_lines_per_vals[key] = (vals, move_lines_per_vals[key][1] | move_line)
+        for vals, move_lines in move_lines_per_vals.values():
+            # the reservation is only changed by the splits, which bypass it
+            move_lines.with_context(bypass_reservation_update=True).write(vals)
+        self._pending_move_line_copies = []
+        self._pending_move_line_writes = {}
+        self._pending_consumed_lot_ids = defaultdict(set)
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _create_extra_move_lines(self, line, quants=None):
+        """Create new sml if quantity produced is bigger than the reserved one"""
+        vals_list = []
+        if quants is None:
+            quants = self.env['stock.quant']._gather(line.product, line.move.location_id, lot_id=line.lot, strict=False)
+        # Search for a sub-locations where the product is available.
+        # Loop on the quants to get the locations. If there is not enough
+        # quantity into stock, we take the move location. Anyway, no
+        # reservation is made, so it is still possible to change it afterwards.
+        for quant in quants:
+            quantity = quant.quantity - quant.reserved_quantity
+            quantity = line.product.uom_id._compute_quantity(quantity, line.product_uom, rounding_method='HALF-UP')
+            rounding = quant.product_uom_id.rounding
+            if (float_compare(quant.quantity, 0, precision_rounding=rounding) <= 0 or
+                    float_compare(quantity, 0, precision_rounding=line.product_uom.rounding) <= 0):
+                continue
+            vals = {
+                'move_id': line.move.id,
+                'product_id': line.product.id,
+                'location_id': quant.location_id.id,
+                'location_dest_id': line.move.location_dest_id.id,
+                'product_uom_qty': 0,
+                'product_uom_id': line.product_uom.id,
+                'qty_done': min(quantity, line.qty_done),
+                'lot_produced_ids': self._get_produced_lots(line),
+            }
+            if line.lot:
+                vals.update({'lot_id': line.lot.id})
+
+            vals_list.append(vals)
+            line.qty_done -= vals['qty_done']
+            # If all the qty_done is distributed, we can close the loop
+            if float_compare(line.qty_done, 0, precision_rounding=line.product.uom_id.rounding) <= 0:
+                break
+
+        if float_compare(line.qty_done, 0, precision_rounding=line.product.uom_id.rounding) > 0:
+            vals = {
+                'move_id': line.move.id,
+                'product_id': line.product.id,
+                'location_id': line.move.location_id.id,
+                'location_dest_id': line.move.location_dest_id.id,
+                'product_uom_qty': 0,
+                'product_uom_id': line.product_uom.id,
+                'qty_done': line.qty_done,
+                'lot_produced_ids': self._get_produced_lots(line),
+            }
+            if line.lot:
+                vals.update({'lot_id': line.lot.id})
+
+            vals_list.append(vals)
+
+        return vals_list
+
+    def _gather_quants(self, keys):
+        """ Batched stock.quant._gather(product, location, lot_id=lot, strict=False):
+        the quants of the keys sharing a removal strategy are read with one
+        query, in the order of that strategy.
+
+        :param keys: set of (product, location, lot)
+        :return: dict mapping each key to its quants
+        """
+        Quant = self.env['stock.quant']
+        keys_per_order = defaultdict(list)
+        for key in keys:
+            product, location, lot = key
+            removal_strategy = Quant._get_removal_strategy(product, location)
+            keys_per_order[Quant._get_removal_strategy_order(removal_strategy)].append(key)
+        if not keys_per_order:
+            return {}
+        # Copy code of _gather for special NULLS FIRST/LAST order
+        Quant.sudo(Quant._uid).check_access_rights('read')
+        quants_per_key = {}
+        for removal_strategy_order, order_keys in keys_per_order.items():
+            domains = []
+            for product, location, lot in order_keys:
+                domain = [('product_id', '=', product.id), ('location_id', 'child_of', location.id)]
+                if lot:
+                    domain = AND([[('lot_id', '=', lot.id)], domain])
+                domains.append(domain)
+            query = Quant._where_calc(OR(domains))
+            Quant._apply_ir_rules(query, 'read')
+            from_clause, where_clause, where_clause_params = query.get_sql()
+            where_str = where_clause and (" WHERE %s" % where_clause) or ''
+            query_str = 'SELECT "%s".id FROM ' % Quant._table + from_clause + where_str + " ORDER BY " + removal_strategy_order
+            self.env.cr.execute(query_str, where_clause_params)
+            quants_per_product = defaultdict(list)
+            for quant in Quant.browse([row[0] for row in self.env.cr.fetchall()]):
+                quants_per_product[quant.product_id].append(quant)
+            for key in order_keys:
+                product, location, lot = key
+                quants_per_key[key] = Quant.concat(*[
+                    quant for quant in quants_per_product[product]
+                    if (not lot or quant.lot_id == lot) and quant.location_id.parent_path.startswith(location.parent_path)
+                ])
+        return quants_per_key
+
+    # method in v13 'mrp_abstract_workorder' but not in v12
+    def _get_produced_lots(self, line):
+        final_lots = self._get_final_lots()
+        return line.move in self.production.move_raw_ids and final_lots and [(4, lot.id) for lot in final_lots]
+
+    # method in v13 'mrp_product_produce' but not in v12
+    def _get_final_lots(self):
+        final_lots = self.finished_lot
+        for line in self.finished_lines:
+            final_lots |= line.lot
+        return final_lots
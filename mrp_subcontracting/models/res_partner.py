@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
-from odoo import fields, models
+from collections import defaultdict
+
+from odoo import api, fields, models
 
 
 class ResPartner(models.Model):
@@ -11,3 +13,68 @@ class ResPartner(models.Model):
         'stock.location', string="Subcontractor Location", company_dependent=True,
         help="The stock location used as source and destination when sending\
         goods to this contact during a subcontracting process.")
+    # inverse of mrp.bom subcontractor_ids
+    direct_subcontract_bom_ids = fields.Many2many(
+        'mrp.bom', 'mrp_bom_subcontractor', 'res_partner_id', 'mrp_bom_id',
+        string='Subcontracting BoMs', copy=False, readonly=True)
+    subcontract_bom_ids = fields.Many2many(
+        'mrp.bom', 'mrp_bom_subcontract_partner_rel', 'partner_id', 'bom_id',
+        string='Eligible Subcontracting BoMs', copy=False,
+        compute='_compute_subcontract_bom_ids', store=True,
+        help="BoMs on which this contact or one of its parents is a subcontractor.")
+
+    @api.depends('direct_subcontract_bom_ids', 'parent_id.subcontract_bom_ids')
+    def _compute_subcontract_bom_ids(self):
+        for partner in self:
+            # archived BoMs are indexed too, whatever the context of the
+            # recompute: the lookups filter them out
+            partner_sudo = partner.sudo().with_context(active_test=False)
+            partner.subcontract_bom_ids = partner_sudo.direct_subcontract_bom_ids | partner_sudo.parent_id.subcontract_bom_ids
+
+    def write(self, vals):
+        res = super(ResPartner, self).write(vals)
+        if 'parent_id' in vals:
+            self._update_subcontract_bom_ids()
+        if 'parent_id' in vals or 'direct_subcontract_bom_ids' in vals:
+            # Subcontracting BoMs are looked up through the partners hierarchy,
+            # and mrp.bom write is bypassed when the BoMs are set from here
+            self.env['mrp.bom'].clear_caches()
+        return res
+
+    @api.model
+    def _get_subcontracting_location_map(self, partner_company_pairs):
+        """ Resolve the subcontracting location of several (partner id,
+        company id) pairs. The company dependent property is read once per
+        company for all the partners, and the values stay in the environment
+        cache of that company for the rest of the transaction. Fall back on the
+        subcontracting location of the company.
+
+        :return: dict mapping each (partner id, company id) to a stock.location
+        """
+        partner_ids_per_company = defaultdict(set)
+        for partner_id, company_id in partner_company_pairs:
+            partner_ids_per_company[company_id].add(partner_id)
+        locations = {}
+        for company_id, partner_ids in partner_ids_per_company.items():
+            company = self.env['res.company'].browse(company_id)
+            partners = self.browse([partner_id for partner_id in partner_ids if partner_id])
+            partners = partners.with_context(force_company=company_id)
+            partners.mapped('property_stock_subcontractor')
+            for partner_id in partner_ids:
+                location = partners.browse(partner_id).property_stock_subcontractor
+                locations[partner_id, company_id] = location or company.subcontracting_location_id
+        return locations
+
+    def _get_subcontracting_location(self, company):
+        """ Return the subcontracting location of the partner in company. """
+        return self._get_subcontracting_location_map([(self.id, company.id)])[self.id, company.id]
+
+    def _update_subcontract_bom_ids(self):
+        """ Recompute the eligible subcontracting BoMs of the partners and of
+        all their children, when their hierarchy or their BoMs changed.
+        """
+        if not self:
+            return
+        partners = self.sudo().with_context(active_test=False).search([('id', 'child_of', self.ids)])
+        partners.modified(['direct_subcontract_bom_ids'])
+        partners.recompute()
@@ -2,24 +2,45 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 from collections import defaultdict
+from contextlib import contextmanager
 
-from odoo import fields, models, _
+from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 from odoo.tools.float_utils import float_compare, float_is_zero
 
+# key of the move ids to check in the cursor cache, see _defer_overprocessed_subcontract_check
+OVERPROCESS_CHECK_KEY = 'mrp_subcontracting.overprocessed_move_ids'
+
 
 class StockMove(models.Model):
     _inherit = 'stock.move'
 
     is_subcontract = fields.Boolean('The move is a subcontract receipt')
+    subcontract_production_id = fields.Many2one(
+        'mrp.production', 'Subcontract Order', compute='_compute_subcontract_production_id',
+        store=True, index=True, readonly=True)
     show_subcontracting_details_visible = fields.Boolean(
         compute='_compute_show_subcontracting_details_visible'
     )
 
+    @api.depends('is_subcontract', 'move_orig_ids.production_id', 'move_orig_ids.production_id.state')
+    def _compute_subcontract_production_id(self):
+        """ The subcontract order producing the move, linked by _subcontracted_produce """
+        for move in self:
+            # the order of a move merged into this one is cancelled
+            productions = move.move_orig_ids.mapped('production_id').filtered(lambda p: p.state != 'cancel')
+            # a move produced by several orders has no single order to follow
+            if move.is_subcontract and len(productions) == 1:
+                move.subcontract_production_id = productions
+            else:
+                move.subcontract_production_id = False
+
     def _compute_show_subcontracting_details_visible(self):
         """ Compute if the action button in order to see moves raw is visible """
+        # Read the subcontract orders of all the moves at once
+        self.mapped('subcontract_production_id').mapped('has_tracked_components')
         for move in self:
-            if move.is_subcontract and move._has_tracked_subcontract_components() and\
+            if move.is_subcontract and move.subcontract_production_id.has_tracked_components and\
                     not float_is_zero(move.quantity_done, precision_rounding=move.product_uom.rounding):
                 move.show_subcontracting_details_visible = True
             else:
@@ -30,10 +51,11 @@ class StockMove(models.Model):
         show details button is visible.
         """
         res = super(StockMove, self)._compute_show_details_visible()
+        self.mapped('subcontract_production_id').mapped('has_tracked_components')
         for move in self:
             if not move.is_subcontract:
                 continue
-            if not move._has_tracked_subcontract_components():
+            if not move.subcontract_production_id.has_tracked_components:
                 continue
             move.show_details_visible = True
         return res
@@ -65,7 +87,7 @@ class StockMove(models.Model):
         self.ensure_one()
         if self.is_subcontract:
             rounding = self.product_uom.rounding
-            production = self.move_orig_ids.production_id
+            production = self.subcontract_production_id
             if self._has_tracked_subcontract_components() and\
                     float_compare(production.qty_produced, production.product_uom_qty, precision_rounding=rounding) < 0 and\
                     float_compare(self.quantity_done, self.product_uom_qty, precision_rounding=rounding) < 0:
@@ -81,7 +103,7 @@ class StockMove(models.Model):
 
     def action_show_subcontract_details(self):
         """ Display moves raw for subcontracted product self. """
-        moves = self.move_orig_ids.production_id.move_raw_ids
+        moves = self.subcontract_production_id.move_raw_ids
         tree_view = self.env.ref('mrp_subcontracting.mrp_subcontracting_move_tree_view')
         form_view = self.env.ref('mrp_subcontracting.mrp_subcontracting_move_form_view')
         return {
@@ -94,40 +116,45 @@ class StockMove(models.Model):
         }
 
     def _action_cancel(self):
-        for move in self:
-            if move.is_subcontract:
-                move.move_orig_ids.production_id.action_cancel()
+        productions = self.filtered('is_subcontract').mapped('subcontract_production_id')\
+            .filtered(lambda p: p.state != 'cancel')
+        if productions:
+            productions._cancel_subcontract_resupply()
+            productions.action_cancel()
         return super()._action_cancel()
 
     def _action_confirm(self, merge=True, merge_into=False):
         subcontract_details_per_picking = defaultdict(list)
-        for move in self:
-            if move.location_id.usage != 'supplier' or move.location_dest_id.usage == 'supplier':
-                continue
-            if move.move_orig_ids.production_id:
-                continue
-            bom = move._get_subcontract_bom()
-            if not bom:
-                continue
+        candidate_moves = self.filtered(lambda m: m.location_id.usage == 'supplier' and
+                                        m.location_dest_id.usage != 'supplier' and
+                                        not m.move_orig_ids.production_id)
+        bom_per_move = candidate_moves._get_subcontract_boms()
+        moves_to_subcontract = candidate_moves.filtered(lambda m: bom_per_move[m])
+        location_per_partner_company = self.env['res.partner']._get_subcontracting_location_map(
+            {(move.picking_id.partner_id.id, move.company_id.id) for move in moves_to_subcontract}
+        )
+        moves_per_location = defaultdict(lambda: self.env['stock.move'])
+        for move in moves_to_subcontract:
+            bom = bom_per_move[move]
             if float_is_zero(move.product_qty, precision_rounding=move.product_uom.rounding) and\
                     move.picking_id.immediate_transfer is True:
                 raise UserError(_("To subcontract, use a planned transfer."))
             subcontract_details_per_picking[move.picking_id].append((move, bom))
-            move.write({
+            moves_per_location[location_per_partner_company[move.picking_id.partner_id.id, move.company_id.id]] |= move
+        for location, moves in moves_per_location.items():
+            moves.write({
                 'is_subcontract': True,
-                'location_id': move.picking_id.partner_id.with_context(force_company=move.company_id.id).property_stock_subcontractor.id
+                'location_id': location.id,
             })
 
         mos = self.env['mrp.production']
         for picking, subcontract_details in subcontract_details_per_picking.items():
-            mos = picking._subcontracted_produce(subcontract_details)
+            mos |= picking._subcontracted_produce(subcontract_details)
 
         # Custom to close Subcontracting Pickings and Manufacture Order, Transfer this to jung_purchase module
         subcontract_moves = self.env['stock.move']
-        for mo in mos:
-            if mo.move_raw_ids:
-                subcontract_moves |= self.env['stock.move'].search(
-                    [('move_dest_ids', 'in', mo.move_raw_ids.ids)])
+        for resupply_moves in mos._get_subcontract_resupply_moves().values():
+            subcontract_moves |= resupply_moves
 
         for m in subcontract_moves:
             fo = m.company_id.industry_in_fiscal_operation_id
@@ -172,11 +199,39 @@ class StockMove(models.Model):
     def _action_record_components(self):
         action = self.env.ref('mrp.act_mrp_product_produce').read()[0]
         action['context'] = dict(
-            default_production_id=self.move_orig_ids.production_id.id,
+            default_production_id=self.subcontract_production_id.id,
             default_subcontract_move_id=self.id
         )
         return action
 
+    @contextmanager
+    def _defer_overprocessed_subcontract_check(self):
+        """ Within the block, the subcontract moves whose move lines are
+        created or written are collected, then checked by
+        _check_overprocessed_subcontract_qty once, on exit. Nested blocks are
+        checked by the outermost one. Nothing is checked if the block raises.
+        """
+        cache = self.env.cr.cache
+        if OVERPROCESS_CHECK_KEY in cache:
+            yield
+            return
+        cache[OVERPROCESS_CHECK_KEY] = set()
+        try:
+            yield
+        finally:
+            move_ids = cache.pop(OVERPROCESS_CHECK_KEY)
+        self.browse(sorted(move_ids)).exists()._check_overprocessed_subcontract_qty()
+
+    def _schedule_overprocessed_subcontract_check(self):
+        """ Check the moves now, or on exit of the current
+        _defer_overprocessed_subcontract_check block.
+        """
+        move_ids = self.env.cr.cache.get(OVERPROCESS_CHECK_KEY)
+        if move_ids is not None:
+            move_ids.update(self.ids)
+        else:
+            self._check_overprocessed_subcontract_qty()
+
     def _check_overprocessed_subcontract_qty(self):
         """ If a subcontracted move use tracked components. Do not allow to add
         quantity without the produce wizard. Instead update the initial demand
@@ -187,11 +242,12 @@ class StockMove(models.Model):
         for move in self:
             if not move.is_subcontract:
                 continue
+            production = move.subcontract_production_id
             # Extra quantity is allowed when components do not need to be register
-            if not move._has_tracked_subcontract_components():
+            if not production.has_tracked_components:
                 continue
             rounding = move.product_uom.rounding
-            if float_compare(move.quantity_done, move.move_orig_ids.production_id.qty_produced, precision_rounding=rounding) > 0:
+            if float_compare(move.quantity_done, production.qty_produced, precision_rounding=rounding) > 0:
                 overprocessed_moves |= move
         if overprocessed_moves:
             raise UserError(_("""
@@ -213,9 +269,25 @@ operations.""") % ('\n'.join(overprocessed_moves.mapped('product_id.display_name
         )
         return bom
 
+    def _get_subcontract_boms(self):
+        """ Batched version of _get_subcontract_bom: resolve the subcontracting
+        BoM of all the moves of self at once.
+
+        :return: dict mapping each move to its BoM (may be empty)
+        """
+        key_per_move = {
+            move: (move.product_id, move.picking_type_id, move.company_id.id, move.picking_id.partner_id)
+            for move in self
+        }
+        bom_per_key = self.env['mrp.bom'].sudo()._bom_subcontract_find_batch(
+            key_per_move.values(),
+            bom_type='subcontract',
+        )
+        return {move: bom_per_key[key] for move, key in key_per_move.items()}
+
     def _has_tracked_subcontract_components(self):
         self.ensure_one()
-        return any(m.has_tracking != 'none' for m in self.move_orig_ids.production_id.move_raw_ids)
+        return self.subcontract_production_id.has_tracked_components
 
     def _prepare_extra_move_vals(self, qty):
         vals = super(StockMove, self)._prepare_extra_move_vals(qty)
@@ -235,11 +307,34 @@ operations.""") % ('\n'.join(overprocessed_moves.mapped('product_id.display_name
         return should_bypass_reservation
 
     def _update_subcontract_order_qty(self, quantity):
+        """ Update the subcontract orders of the moves to their new quantity.
+        The changes are summed per order and applied by one batch of
+        change.production.qty wizards, the components being reserved once at
+        the end instead of once per order.
+        """
+        quantity_change_per_production = defaultdict(float)
         for move in self:
-            quantity_change = quantity - move.product_uom_qty
-            production = move.move_orig_ids.production_id
+            production = move.subcontract_production_id
             if production:
-                self.env['change.production.qty'].with_context(skip_activity=True).create({
-                    'mo_id': production.id,
-                    'product_qty': production.product_uom_qty + quantity_change
-                }).change_prod_qty()
+                quantity_change_per_production[production] += quantity - move.product_uom_qty
+        if not quantity_change_per_production:
+            return
+        productions = self.env['mrp.production'].concat(*quantity_change_per_production.keys())
+        self.env['change.production.qty'].with_context(
+            skip_activity=True,
+            subcontract_defer_assign_production_ids=tuple(productions.ids),
+        ).create([{
+            'mo_id': production.id,
+            'product_qty': production.product_uom_qty + quantity_change
+        } for production, quantity_change in quantity_change_per_production.items()]).change_prod_qty()
+        productions.mapped('move_raw_ids').filtered(lambda m: m.state not in ('done', 'cancel'))._action_assign()
+
+    def _action_assign(self):
+        """ Do not reserve the components of the subcontract orders being
+        updated by _update_subcontract_order_qty, it reserves them at once.
+        """
+        production_ids = self.env.context.get('subcontract_defer_assign_production_ids')
+        if not production_ids:
+            return super(StockMove, self)._action_assign()
+        moves = self.filtered(lambda m: m.raw_material_production_id.id not in production_ids)
+        return super(StockMove, moves)._action_assign()
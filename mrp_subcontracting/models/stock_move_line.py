@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from collections import defaultdict
+
 from odoo import models, fields
 
 
@@ -11,25 +13,33 @@ class StockMoveLine(models.Model):
 
     def create(self, values):
         records = super(StockMoveLine, self).create(values)
-        records.filtered(lambda ml: ml.move_id.is_subcontract).mapped('move_id')._check_overprocessed_subcontract_qty()
+        records.filtered(lambda ml: ml.move_id.is_subcontract).mapped('move_id')._schedule_overprocessed_subcontract_check()
         return records
 
     def write(self, vals):
+        if set(vals) == {'date'}:
+            # Dates change neither the processed quantities nor the traceability
+            return super(StockMoveLine, self).write(vals)
+
+        # in v13 addons/mrp/models/stock_move.py, grouped per production: the
+        # component lines are scanned once
+        lots_per_production = defaultdict(lambda: self.env['stock.production.lot'])
+        if 'lot_id' in vals:
+            for move_line in self:
+                if move_line.move_id.production_id:
+                    lots_per_production[move_line.production_id] |= move_line.lot_id
+        component_lines = self.env['stock.move.line']
+        for production, lots in lots_per_production.items():
+            component_lines |= production.move_raw_ids.mapped('move_line_ids')\
+                .filtered(lambda r: not r.done_move and r.lot_produced_ids & lots)
+        if component_lines:
+            component_lines.write({'lot_produced_ids': [(4, vals['lot_id'])]})
+
+        # mrp logs a message per done move line, post them once per production
+        with self.env['mrp.production']._group_tracking_messages():
+            res = super(StockMoveLine, self).write(vals)
         # in v13 'mrp_subcontracting'
-        res = super(StockMoveLine, self).write(vals)
-
-        self.filtered(lambda ml: ml.move_id.is_subcontract).mapped('move_id')._check_overprocessed_subcontract_qty()
-
-        # in v13 addons/mrp/models/stock_move.py
-        for move_line in self:
-            if move_line.move_id.production_id and 'lot_id' in vals:
-                move_line.production_id.move_raw_ids.mapped('move_line_ids')\
-                    .filtered(lambda r: not r.done_move and move_line.lot_id in r.lot_produced_ids)\
-                    .write({'lot_produced_ids': [(4, vals['lot_id'])]})
-            production = move_line.move_id.production_id or move_line.move_id.raw_material_production_id
-            if production and move_line.state == 'done' and any(field in vals for field in ('lot_id', 'location_id', 'qty_done')):
-                move_line._log_message(production, move_line, 'mrp.track_production_move_template', vals)
-
+        self.filtered(lambda ml: ml.move_id.is_subcontract).mapped('move_id')._schedule_overprocessed_subcontract_check()
         return res
 
     def _should_bypass_reservation(self, location):
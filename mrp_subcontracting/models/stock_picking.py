@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from collections import defaultdict
 from datetime import timedelta
 
-from odoo import api, fields, models
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from odoo.addons.mrp_subcontracting.models.production_recorder import ProductionRecorder
 
 
 class StockPicking(models.Model):
@@ -13,6 +17,9 @@ class StockPicking(models.Model):
 
     @api.depends('state')
     def _compute_display_action_record_components(self):
+        # Read the subcontract orders of all the pickings at once, from the
+        # stored fields on the moves and on the orders
+        self.mapped('move_lines.subcontract_production_id').mapped('has_tracked_components')
         for picking in self:
             # Hide if not encoding state
             if picking.state in ('draft', 'cancel', 'done'):
@@ -23,8 +30,7 @@ class StockPicking(models.Model):
                 continue
             # Hide if no components are track
             subcontracted_productions = picking._get_subcontracted_productions()
-            subcontracted_moves = subcontracted_productions.mapped('move_raw_ids')
-            if all(subcontracted_move.has_tracking == 'none' for subcontracted_move in subcontracted_moves):
+            if not any(production.has_tracked_components for production in subcontracted_productions):
                 picking.display_action_record_components = False
                 continue
             # Hide if the production is to close
@@ -38,14 +44,25 @@ class StockPicking(models.Model):
     # -------------------------------------------------------------------------
 
     def action_done(self):
-        res = super(StockPicking, self).action_done()
+        # Check the overprocessed subcontract moves once, when all the move
+        # lines of the transfer are saved
+        with self.env['stock.move']._defer_overprocessed_subcontract_check():
+            res = super(StockPicking, self).action_done()
         productions = self.env['mrp.production']
+        pickings_per_production = defaultdict(lambda: self.env['stock.picking'])
+        uom_factors = {}
 
         for picking in self:
             for move in picking.move_lines:
                 if not move.is_subcontract:
                     continue
-                production = move.move_orig_ids.production_id
+                production = move.subcontract_production_id
+                if not production:
+                    if len(move.move_orig_ids.mapped('production_id').filtered(lambda p: p.state != 'cancel')) > 1:
+                        raise UserError(_("The subcontracted product %s is produced by several subcontract orders, "
+                                          "they cannot be recorded from the receipt %s.")
+                                        % (move.product_id.display_name, picking.name))
+                    continue
                 if move._has_tracked_subcontract_components():
                     move.move_orig_ids.filtered(lambda m: m.state not in ('done', 'cancel')).move_line_ids.unlink()
                     move_finished_ids = move.move_orig_ids.filtered(lambda m: m.state not in ('done', 'cancel'))
@@ -60,36 +77,40 @@ class StockPicking(models.Model):
                             'location_dest_id': move_finished_ids.location_dest_id.id,
                         })
                 else:
+                    # Register the production once per finished lot instead of
+                    # once per receipt line (e.g. one line per package).
+                    qty_per_lot_and_uom = defaultdict(float)
                     for move_line in move.move_line_ids:
-                        # In v13 change 'active_id' to 'default_production_id'
-                        # cf changes in the mrp.product.produce 'default_get'
-                        produce = self.env['mrp.product.produce'].with_context(active_id=production.id).create({
-                            'production_id': production.id,
-                            # 'qty_producing' : move_line.qty_done, # 'product_qty' in v12
-                            'product_qty': move_line.qty_done,
-                            'product_uom_id': move_line.product_uom_id.id,
-                            'finished_lot_id': move_line.lot_id.id, # not in v12
-                            'consumption': 'strict', # not in v12
-                        })
-                        produce._generate_produce_lines()
-                        produce._record_production()
+                        qty_per_lot_and_uom[move_line.lot_id, move_line.product_uom_id] += move_line.qty_done
+                    for (lot, uom), quantity in qty_per_lot_and_uom.items():
+                        recorder = ProductionRecorder(
+                            production, quantity, uom, finished_lot=lot, consumption='strict', uom_factors=uom_factors)
+                        recorder.generate_lines()
+                        recorder.record()
                 productions |= production
-            for subcontracted_production in productions:
-                if subcontracted_production.state == 'progress':
-                    subcontracted_production.post_inventory()
-                else:
-                    subcontracted_production.button_mark_done()
-                # For concistency, set the date on production move before the date
-                # on picking. (Tracability report + Product Moves menu item)
-                minimum_date = min(picking.move_line_ids.mapped('date'))
-                production_moves = subcontracted_production.move_raw_ids | subcontracted_production.move_finished_ids
-                production_moves.write({'date': minimum_date - timedelta(seconds=1)})
-                # In v13 :
-                # production_moves.move_line_ids.write({'date': minimum_date - timedelta(seconds=1)})
-                # In v12 :
-                for move in production_moves:
-                    for ml in move.move_line_ids:
-                        ml.write({'date': minimum_date - timedelta(seconds=1)})
+                pickings_per_production[production] |= picking
+
+        # Close every production once, whatever the number of receipts it
+        # appears in.
+        productions_in_progress = productions.filtered(lambda p: p.state == 'progress')
+        productions_in_progress.post_inventory()
+        for subcontracted_production in productions - productions_in_progress:
+            subcontracted_production.button_mark_done()
+
+        # For concistency, set the date on production move before the date
+        # on picking. (Tracability report + Product Moves menu item)
+        minimum_date_per_picking = {}
+        productions_per_date = defaultdict(lambda: self.env['mrp.production'])
+        for subcontracted_production in productions:
+            for picking in pickings_per_production[subcontracted_production]:
+                if picking not in minimum_date_per_picking:
+                    minimum_date_per_picking[picking] = min(picking.move_line_ids.mapped('date'))
+            minimum_date = min(minimum_date_per_picking[picking] for picking in pickings_per_production[subcontracted_production])
+            productions_per_date[minimum_date - timedelta(seconds=1)] |= subcontracted_production
+        for date, date_productions in productions_per_date.items():
+            production_moves = date_productions.mapped('move_raw_ids') | date_productions.mapped('move_finished_ids')
+            production_moves.write({'date': date})
+            production_moves.mapped('move_line_ids').write({'date': date})
         return res
 
     # TODO : add action_cancel()
@@ -104,7 +125,7 @@ class StockPicking(models.Model):
         for move in self.move_lines:
             if not move._has_tracked_subcontract_components():
                 continue
-            production = move.move_orig_ids.production_id
+            production = move.subcontract_production_id
             if not production or production.state in ('done', 'to_close'):
                 continue
             return move._action_record_components()
@@ -118,27 +139,32 @@ class StockPicking(models.Model):
 
     def _get_subcontracted_productions(self):
         self.ensure_one()
-        return self.move_lines.mapped('move_orig_ids.production_id')
+        return self.move_lines.mapped('subcontract_production_id')
 
     def _get_warehouse(self, subcontract_move):
         return subcontract_move.warehouse_id or self.picking_type_id.warehouse_id
 
-    def _prepare_subcontract_mo_vals(self, subcontract_move, bom):
-        subcontract_move.ensure_one()
-        group = self.env['procurement.group'].create({
+    def _prepare_subcontract_group_vals(self):
+        return {
             'name': self.name,
             'partner_id': self.partner_id.id,
-        })
+        }
+
+    def _prepare_subcontract_mo_vals(self, subcontract_move, bom, group=False):
+        subcontract_move.ensure_one()
+        if not group:
+            group = self.env['procurement.group'].create(self._prepare_subcontract_group_vals())
         product = subcontract_move.product_id
         warehouse = self._get_warehouse(subcontract_move)
+        subcontract_location = self.partner_id._get_subcontracting_location(subcontract_move.company_id)
         vals = {
             'company_id': subcontract_move.company_id.id,
             'procurement_group_id': group.id,
             'product_id': product.id,
             'product_uom_id': subcontract_move.product_uom.id,
             'bom_id': bom.id,
-            'location_src_id': subcontract_move.picking_id.partner_id.with_context(force_company=subcontract_move.company_id.id).property_stock_subcontractor.id,
-            'location_dest_id': subcontract_move.picking_id.partner_id.with_context(force_company=subcontract_move.company_id.id).property_stock_subcontractor.id,
+            'location_src_id': subcontract_location.id,
+            'location_dest_id': subcontract_location.id,
             'product_qty': subcontract_move.product_uom_qty,
             'picking_type_id': warehouse.subcontracting_type_id.id
         }
@@ -146,15 +172,45 @@ class StockPicking(models.Model):
 
     def _subcontracted_produce(self, subcontract_details):
         self.ensure_one()
+        # Each MO keeps its own procurement group: cancelling a MO cancels all
+        # the pickings of its group, i.e. the resupply of the other MOs.
+        groups = self.env['procurement.group'].create(
+            [self._prepare_subcontract_group_vals() for dummy in subcontract_details]
+        )
+        details_per_company = defaultdict(list)
+        for (move, bom), group in zip(subcontract_details, groups):
+            details_per_company[move.company_id].append((move, bom, group))
         mos = self.env['mrp.production']
-        for move, bom in subcontract_details:
-            mo = self.env['mrp.production'].with_context(force_company=move.company_id.id).create(self._prepare_subcontract_mo_vals(move, bom))
+        links = []
+        for company, details in details_per_company.items():
+            company_mos = self.env['mrp.production'].with_context(force_company=company.id).create([
+                self._prepare_subcontract_mo_vals(move, bom, group=group) for move, bom, group in details
+            ])
             # self.env['stock.move'].create(mo._get_moves_raw_values())
             # mo.action_confirm()
-            mos |= mo
-            # Link the finished to the receipt move.
-            finished_move = mo.move_finished_ids.filtered(lambda m: m.product_id == move.product_id)
-            finished_move.write({'move_dest_ids': [(4, move.id, False)]})
-            mo.action_assign()
-
+            mos |= company_mos
+            for mo, (move, bom, group) in zip(company_mos, details):
+                finished_move = mo.move_finished_ids.filtered(lambda m: m.product_id == move.product_id)
+                links += [(finished_move_id, move.id) for finished_move_id in finished_move.ids]
+        self._link_subcontract_moves(links)
+        # one reservation pass for the components of all the MOs
+        mos.mapped('move_raw_ids')._action_assign()
         return mos
+
+    @api.model
+    def _link_subcontract_moves(self, links):
+        """ Link the finished moves of the subcontract MOs to their receipt
+        moves with a single insert in the move_dest_ids relation.
+
+        :param links: list of (finished move id, receipt move id)
+        """
+        if not links:
+            return
+        field = self.env['stock.move']._fields['move_dest_ids']
+        finished_move_ids, receipt_move_ids = zip(*links)
+        self.env.cr.execute(
+            'INSERT INTO "{}" ("{}", "{}") SELECT * FROM unnest(%s, %s)'.format(field.relation, field.column1, field.column2),
+            (list(finished_move_ids), list(receipt_move_ids))
+        )
+        self.env['stock.move'].browse(finished_move_ids).modified(['move_dest_ids'])
+        self.env['stock.move'].browse(receipt_move_ids).modified(['move_orig_ids'])
@@ -1,4 +1,4 @@
 # -*- coding: utf-8 -*-
 
 from . import test_subcontracting
-
+from . import test_subcontracting_benchmark
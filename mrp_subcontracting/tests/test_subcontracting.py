@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from unittest.mock import patch
+
+from odoo.exceptions import UserError
 from odoo.tests import Form
 from odoo.tests.common import TransactionCase
 from odoo.addons.mrp_subcontracting.tests.common import TestMrpSubcontractingCommon
+from odoo.addons.mrp_subcontracting.models.production_recorder import ProduceLine, ProductionRecorder
 
 from odoo.tests import tagged
 
@@ -596,6 +600,380 @@ class TestSubcontractingFlows(TestMrpSubcontractingCommon):
         mo = self.env['mrp.production'].search([('bom_id', '=', self.bom.id)])
         self.assertEqual(len(mo), 1)
 
+    def test_subcontract_bom_batch_resolution(self):
+        """The batched BoM resolution gives the same result as the per move
+        resolution, including for children contacts and non subcontracted
+        products.
+        """
+        subcontractor_contact = self.env['res.partner'].create({
+            'name': 'Test children subcontractor contact',
+            'parent_id': self.subcontractor_partner1.id,
+        })
+        other_partner = self.env['res.partner'].create({'name': 'Not a subcontractor'})
+        moves = self.env['stock.move']
+        for partner in (self.subcontractor_partner1, subcontractor_contact, other_partner):
+            picking_form = Form(self.env['stock.picking'])
+            picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+            picking_form.partner_id = partner
+            for product in (self.finished, self.comp2):
+                with picking_form.move_ids_without_package.new() as move:
+                    move.product_id = product
+                    move.product_uom_qty = 1
+            moves |= picking_form.save().move_lines
+        bom_per_move = moves._get_subcontract_boms()
+        self.assertEqual(len(bom_per_move), 6)
+        for move in moves:
+            self.assertEqual(bom_per_move[move], move._get_subcontract_bom())
+        self.assertEqual(sum(len(bom) for bom in bom_per_move.values()), 2)
+
+    def test_subcontract_bom_cache(self):
+        """The subcontracting BoM lookups are cached and the cache follows the
+        changes on the BoMs and on the partners hierarchy.
+        """
+        bom_model = self.env['mrp.bom'].sudo()
+        subcontractor_contact = self.env['res.partner'].create({
+            'name': 'Test children subcontractor contact',
+            'parent_id': self.subcontractor_partner1.id,
+        })
+
+        def find_bom():
+            return bom_model._bom_subcontract_find(product=self.finished, subcontractor=subcontractor_contact)
+
+        self.assertEqual(find_bom(), self.bom)
+        stats = bom_model._get_bom_find_cache_stats()
+        self.assertEqual(find_bom(), self.bom)
+        self.assertEqual(bom_model._get_bom_find_cache_stats()['hit'], stats['hit'] + 1)
+
+        subcontractor_contact.parent_id = False
+        self.assertFalse(find_bom())
+        subcontractor_contact.parent_id = self.subcontractor_partner1
+        self.assertEqual(find_bom(), self.bom)
+        # the cache is kept by the writes on other fields than the lookup ones
+        stats = bom_model._get_bom_find_cache_stats()
+        self.bom.code = 'cache test'
+        self.assertEqual(find_bom(), self.bom)
+        self.assertEqual(bom_model._get_bom_find_cache_stats()['hit'], stats['hit'] + 1)
+        # archived BoMs are never cached, even for callers disabling active_test
+        self.bom.active = False
+        self.assertFalse(bom_model.with_context(active_test=False)._bom_subcontract_find(
+            product=self.finished, subcontractor=subcontractor_contact))
+        self.assertFalse(find_bom())
+        self.bom.active = True
+        self.assertEqual(find_bom(), self.bom)
+        self.bom.subcontractor_ids = [(3, self.subcontractor_partner1.id)]
+        self.assertFalse(find_bom())
+
+    def test_subcontract_bom_ancestry(self):
+        """Every contact under a subcontractor is mapped to the subcontracting
+        BoMs of its parents, and the mapping follows the hierarchy changes.
+        """
+        main_partner = self.subcontractor_partner1.parent_id
+        subcontractor_contact = self.env['res.partner'].create({
+            'name': 'Test children subcontractor contact',
+            'parent_id': self.subcontractor_partner1.id,
+        })
+        subcontractor_subcontact = self.env['res.partner'].create({
+            'name': 'Test grandchildren subcontractor contact',
+            'parent_id': subcontractor_contact.id,
+        })
+        self.assertFalse(main_partner.subcontract_bom_ids)
+        self.assertEqual(self.subcontractor_partner1.subcontract_bom_ids, self.bom)
+        self.assertEqual(subcontractor_subcontact.subcontract_bom_ids, self.bom)
+        self.assertIn(subcontractor_subcontact, self.bom.subcontract_partner_ids)
+
+        subcontractor_contact.parent_id = main_partner
+        self.assertFalse(subcontractor_contact.subcontract_bom_ids)
+        self.assertFalse(subcontractor_subcontact.subcontract_bom_ids)
+        self.bom.subcontractor_ids = [(4, main_partner.id)]
+        self.assertEqual(subcontractor_subcontact.subcontract_bom_ids, self.bom)
+        self.bom.subcontractor_ids = [(3, main_partner.id)]
+        self.assertFalse(subcontractor_subcontact.subcontract_bom_ids)
+
+    def test_subcontract_bom_ancestry_archived(self):
+        """A contact created while a BoM of its parents is archived gets the
+        BoM back when it is unarchived.
+        """
+        self.bom.active = False
+        subcontractor_contact = self.env['res.partner'].create({
+            'name': 'Test children subcontractor contact',
+            'parent_id': self.subcontractor_partner1.id,
+        })
+        self.assertEqual(subcontractor_contact.with_context(active_test=False).subcontract_bom_ids, self.bom)
+        self.bom.active = True
+        self.assertEqual(subcontractor_contact.subcontract_bom_ids, self.bom)
+
+    def test_supplierinfo_is_subcontractor(self):
+        """The subcontracted flag of the vendor lines is stored and follows the
+        subcontractors of the BoMs.
+        """
+        other_vendor = self.env['res.partner'].create({'name': 'Regular vendor'})
+        supplierinfos = self.env['product.supplierinfo'].create([{
+            'name': partner.id,
+            'product_tmpl_id': self.finished.product_tmpl_id.id,
+        } for partner in (self.subcontractor_partner1, other_vendor)])
+        subcontracted = self.env['product.supplierinfo'].search([
+            ('id', 'in', supplierinfos.ids),
+            ('is_subcontractor', '=', True),
+        ])
+        self.assertEqual(subcontracted.name, self.subcontractor_partner1)
+        self.bom.subcontractor_ids = [(4, other_vendor.id)]
+        self.assertTrue(all(supplierinfos.mapped('is_subcontractor')))
+        self.bom.type = 'normal'
+        self.assertFalse(any(supplierinfos.mapped('is_subcontractor')))
+
+    def test_supplierinfo_is_subcontractor_variant_bom(self):
+        """A subcontract BoM of a single variant only flags the vendor lines of
+        that variant, and archived BoMs flag no vendor line.
+        """
+        self.bom.product_id = self.finished
+        supplierinfo_template, supplierinfo_variant = self.env['product.supplierinfo'].create([{
+            'name': self.subcontractor_partner1.id,
+            'product_tmpl_id': self.finished.product_tmpl_id.id,
+        }, {
+            'name': self.subcontractor_partner1.id,
+            'product_tmpl_id': self.finished.product_tmpl_id.id,
+            'product_id': self.finished.id,
+        }])
+        self.assertFalse(supplierinfo_template.is_subcontractor)
+        self.assertTrue(supplierinfo_variant.is_subcontractor)
+        self.bom.active = False
+        self.assertFalse(supplierinfo_variant.is_subcontractor)
+        self.bom.active = True
+        self.bom.product_id = False
+        self.assertTrue(supplierinfo_template.is_subcontractor)
+
+    def test_flow_several_receipts(self):
+        """Validating several receipts at once closes each subcontracting
+        order and sets its moves before its own receipt.
+        """
+        pickings = self.env['stock.picking']
+        for quantity in (1, 2):
+            picking_form = Form(self.env['stock.picking'])
+            picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+            picking_form.partner_id = self.subcontractor_partner1
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = self.finished
+                move.product_uom_qty = quantity
+            pickings |= picking_form.save()
+        pickings.action_confirm()
+        for picking in pickings:
+            picking.move_lines.quantity_done = picking.move_lines.product_uom_qty
+        pickings.action_done()
+
+        for picking in pickings:
+            production = picking.move_lines.move_orig_ids.production_id
+            self.assertEqual(len(production), 1)
+            self.assertEqual(production.state, 'done')
+            minimum_date = min(picking.move_line_ids.mapped('date'))
+            production_moves = production.move_raw_ids | production.move_finished_ids
+            self.assertTrue(all(date < minimum_date for date in production_moves.mapped('date')))
+
+    def test_flow_confirm_several_receipts(self):
+        """Confirming several receipts at once produces and closes the
+        subcontracting order of each receipt, not only the ones of the last
+        receipt.
+        """
+        pickings = self.env['stock.picking']
+        for quantity in (1, 2):
+            picking_form = Form(self.env['stock.picking'])
+            picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+            picking_form.partner_id = self.subcontractor_partner1
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = self.finished
+                move.product_uom_qty = quantity
+            pickings |= picking_form.save()
+        pickings.action_confirm()
+
+        productions = pickings.mapped('move_lines.move_orig_ids.production_id')
+        self.assertEqual(len(productions), 2)
+        for picking in pickings:
+            production = picking.move_lines.move_orig_ids.production_id
+            self.assertEqual(production.product_qty, picking.move_lines.product_uom_qty)
+            self.assertEqual(production.qty_produced, production.product_qty)
+        self.assertEqual(len(set(productions.mapped('state'))), 1)
+
+    def test_subcontract_production_several_origins(self):
+        """A receipt move coming from several subcontracting orders has no
+        subcontracting order.
+        """
+        pickings = self.env['stock.picking']
+        for quantity in (1, 2):
+            picking_form = Form(self.env['stock.picking'])
+            picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+            picking_form.partner_id = self.subcontractor_partner1
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = self.finished
+                move.product_uom_qty = quantity
+            pickings |= picking_form.save()
+        pickings.action_confirm()
+        move1, move2 = pickings.mapped('move_lines')
+        self.assertTrue(move1.subcontract_production_id)
+        move1.move_orig_ids |= move2.move_orig_ids
+        self.assertFalse(move1.subcontract_production_id)
+        self.assertEqual(len(move2.subcontract_production_id), 1)
+
+    def test_flow_cancel_receipt_line(self):
+        """Cancelling a line of a receipt cancels the components sent for its
+        subcontracting order only, the other lines are still resupplied.
+        """
+        resupply_sub_on_order_route = self.env['stock.location.route'].search([
+            ('name', '=', 'Resupply Subcontractor on Order')
+        ])
+        comp3 = self.env['product.product'].create({
+            'name': 'Component3',
+            'type': 'product',
+            'categ_id': self.env.ref('product.product_category_all').id,
+        })
+        (self.comp1 | self.comp2 | comp3).write({
+            'route_ids': [(4, resupply_sub_on_order_route.id)]
+        })
+        finished2 = self.env['product.product'].create({
+            'name': 'finished2',
+            'type': 'product',
+            'categ_id': self.env.ref('product.product_category_all').id,
+        })
+        bom_form = Form(self.env['mrp.bom'])
+        bom_form.type = 'subcontract'
+        bom_form.subcontractor_ids.add(self.subcontractor_partner1)
+        bom_form.product_tmpl_id = finished2.product_tmpl_id
+        with bom_form.bom_line_ids.new() as bom_line:
+            bom_line.product_id = comp3
+            bom_line.product_qty = 1
+        bom_form.save()
+
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        for product in (self.finished, finished2):
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = product
+                move.product_uom_qty = 5
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+
+        resupply_moves = self.env['stock.move'].search([
+            ('product_id', 'in', (self.comp1 | self.comp2 | comp3).ids),
+            ('picking_id', '!=', False),
+        ])
+        self.assertEqual(len(resupply_moves), 3)
+        move_finished = picking_receipt.move_lines.filtered(lambda m: m.product_id == self.finished)
+        move_finished._action_cancel()
+
+        self.assertEqual(move_finished.subcontract_production_id.state, 'cancel')
+        for move in resupply_moves:
+            if move.product_id == comp3:
+                self.assertNotEqual(move.state, 'cancel')
+            else:
+                self.assertEqual(move.state, 'cancel')
+        comp3_picking = resupply_moves.filtered(lambda m: m.product_id == comp3).picking_id
+        self.assertNotEqual(comp3_picking.state, 'cancel')
+        self.assertEqual(self.comp1.virtual_available, 0.0)
+        self.assertEqual(comp3.virtual_available, -5)
+
+    def test_flow_receipt_merged_lines(self):
+        """Two lines of the same product on a receipt are merged: the order of
+        the merged line is cancelled and the remaining order, updated to the
+        whole quantity, is recorded and closed by the validation.
+        """
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        for quantity in (1, 2):
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = self.finished
+                move.product_uom_qty = quantity
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+
+        move = picking_receipt.move_lines
+        self.assertEqual(len(move), 1)
+        self.assertEqual(move.product_uom_qty, 3)
+        self.assertEqual(len(move.move_orig_ids.mapped('production_id')), 2)
+        production = move.subcontract_production_id
+        self.assertEqual(len(production), 1)
+        self.assertEqual(production.product_qty, 3)
+
+        move.quantity_done = 3
+        picking_receipt.action_done()
+        self.assertEqual(picking_receipt.state, 'done')
+        self.assertEqual(production.state, 'done')
+        self.assertEqual(production.qty_produced, 3)
+
+    def test_update_subcontract_order_qty(self):
+        """Updating the demand of several receipt moves updates their orders
+        and reserves their components once, at the end. The components of the
+        other orders are still reserved meanwhile.
+        """
+        pickings = self.env['stock.picking']
+        for dummy in range(3):
+            picking_form = Form(self.env['stock.picking'])
+            picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+            picking_form.partner_id = self.subcontractor_partner1
+            with picking_form.move_ids_without_package.new() as move:
+                move.product_id = self.finished
+                move.product_uom_qty = 1
+            pickings |= picking_form.save()
+        pickings.action_confirm()
+        move1, move2, move3 = pickings.mapped('move_lines')
+        mo1, mo2, mo3 = [move.subcontract_production_id for move in (move1, move2, move3)]
+        location = mo1.move_raw_ids[0].location_id
+        for component in (self.comp1, self.comp2):
+            self.env['stock.quant']._update_available_quantity(component, location, 20)
+
+        # within the block, only the components of the other orders are reserved
+        (mo1 | mo3).mapped('move_raw_ids').with_context(
+            subcontract_defer_assign_production_ids=(mo1.id,))._action_assign()
+        self.assertTrue(all(state == 'assigned' for state in mo3.move_raw_ids.mapped('state')))
+        self.assertFalse(any(mo1.move_raw_ids.mapped('reserved_availability')))
+
+        StockMove = type(self.env['stock.move'])
+        action_assign = StockMove._action_assign
+        calls = []
+
+        def _action_assign(moves):
+            calls.append((moves, moves.env.context.get('subcontract_defer_assign_production_ids')))
+            return action_assign(moves)
+
+        with patch.object(StockMove, '_action_assign', _action_assign):
+            (move1 | move2).write({'product_uom_qty': 3})
+
+        self.assertEqual(mo1.product_qty, 3)
+        self.assertEqual(mo2.product_qty, 3)
+        self.assertEqual(mo3.product_qty, 1)
+        raw_moves = (mo1 | mo2).mapped('move_raw_ids')
+        # the deferred calls skip the components of both orders
+        for moves, production_ids in calls:
+            if production_ids:
+                self.assertIn(mo1.id, production_ids)
+                self.assertIn(mo2.id, production_ids)
+        reservations = [moves & raw_moves for moves, production_ids in calls if not production_ids and moves & raw_moves]
+        self.assertEqual(reservations, [raw_moves])
+        self.assertTrue(all(state == 'assigned' for state in raw_moves.mapped('state')))
+        self.assertEqual(sum(mo1.move_raw_ids.mapped('reserved_availability')), 6)
+
+    def test_flow_receipt_without_produce_lines(self):
+        """Validating a receipt records the production without creating any
+        produce wizard line.
+        """
+        produce_line_count = self.env['mrp.product.produce.line'].search_count([])
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        with picking_form.move_ids_without_package.new() as move:
+            move.product_id = self.finished
+            move.product_uom_qty = 3
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+        picking_receipt.move_lines.quantity_done = 3
+        picking_receipt.action_done()
+
+        production = picking_receipt.move_lines.move_orig_ids.production_id
+        self.assertEqual(production.state, 'done')
+        for move in production.move_raw_ids:
+            self.assertEqual(move.state, 'done')
+            self.assertEqual(move.quantity_done, 3)
+        self.assertEqual(self.env['mrp.product.produce.line'].search_count([]), produce_line_count)
+
 
 class TestSubcontractingTracking(TransactionCase):
     def setUp(self):
@@ -717,3 +1095,221 @@ class TestSubcontractingTracking(TransactionCase):
         self.assertEquals(avail_qty_comp1, -1)
         self.assertEquals(avail_qty_comp2, -1)
         self.assertEquals(avail_qty_finished, 1)
+
+    def test_serial_range_lines(self):
+        """ The unreserved serial numbers to consume are planned as one line,
+        kept as one row of the produce wizard until their serial numbers are
+        entered.
+        """
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        with picking_form.move_ids_without_package.new() as move:
+            move.product_id = self.finished_lot
+            move.product_uom_qty = 5
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+        mo = self.env['mrp.production'].search([('bom_id', '=', self.bom_tracked.id)])
+
+        recorder = ProductionRecorder(mo, 5, mo.product_uom_id)
+        raw_lines, finished_lines = recorder.generate_lines()
+        serial_lines = [line for line in raw_lines if line.product == self.comp1_sn]
+        self.assertEqual(len(serial_lines), 1)
+        self.assertEqual(serial_lines[0].qty_to_consume, 5)
+
+        produce = self.env['mrp.product.produce'].with_context(active_id=mo.id).create({
+            'production_id': mo.id,
+            'product_qty': 5,
+            'product_uom_id': mo.product_uom_id.id,
+        })
+        produce._generate_produce_lines()
+        serial_rows = produce.raw_workorder_line_ids.filtered(lambda line: line.product_id == self.comp1_sn)
+        self.assertEqual(len(serial_rows), 1)
+        self.assertEqual(serial_rows.qty_to_consume, 5)
+
+        serial = self.env['stock.production.lot'].create({
+            'name': 'sn1',
+            'product_id': self.comp1_sn.id,
+            'company_id': self.env.user.company_id.id,
+        })
+        serial_rows.lot_id = serial
+        serial_rows = produce.raw_workorder_line_ids.filtered(lambda line: line.product_id == self.comp1_sn)
+        self.assertEqual(len(serial_rows), 2)
+        self.assertEqual(serial_rows.filtered('lot_id').qty_to_consume, 1)
+        self.assertEqual(serial_rows.filtered('lot_id').qty_done, 1)
+        self.assertEqual(serial_rows.filtered(lambda line: not line.lot_id).qty_to_consume, 4)
+
+    def test_overprocessed_check_deferred(self):
+        """ Processing a subcontracted product with tracked components without
+        registering them is refused when the deferred check block exits.
+        """
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        with picking_form.move_ids_without_package.new() as move:
+            move.product_id = self.finished_lot
+            move.product_uom_qty = 1
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+
+        with self.assertRaises(UserError):
+            with self.env['stock.move']._defer_overprocessed_subcontract_check():
+                picking_receipt.move_lines.quantity_done = 1
+                # not checked before the end of the block
+                self.assertEqual(picking_receipt.move_lines.quantity_done, 1)
+
+    def test_overprocessed_check_action_done(self):
+        """ A tracked subcontracted product processed by the validation of the
+        receipt itself, without registering its components, is refused.
+        """
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        with picking_form.move_ids_without_package.new() as move:
+            move.product_id = self.finished_lot
+            move.product_uom_qty = 1
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+        lot = self.env['stock.production.lot'].create({
+            'name': 'lot1',
+            'product_id': self.finished_lot.id,
+            'company_id': self.env.user.company_id.id,
+        })
+        # a line without move: action_done creates and confirms its move,
+        # subcontracted to a new order with nothing produced
+        self.env['stock.move.line'].create({
+            'picking_id': picking_receipt.id,
+            'product_id': self.finished_lot.id,
+            'product_uom_id': self.finished_lot.uom_id.id,
+            'lot_id': lot.id,
+            'qty_done': 1,
+            'location_id': picking_receipt.location_id.id,
+            'location_dest_id': picking_receipt.location_dest_id.id,
+        })
+        with self.assertRaises(UserError):
+            picking_receipt.action_done()
+
+    def _create_reserved_production(self, quantity):
+        """ Confirm a receipt of quantity finished products and reserve its
+        components in the subcontracting location, one serial number per unit.
+        """
+        picking_form = Form(self.env['stock.picking'])
+        picking_form.picking_type_id = self.env.ref('stock.picking_type_in')
+        picking_form.partner_id = self.subcontractor_partner1
+        with picking_form.move_ids_without_package.new() as move:
+            move.product_id = self.finished_lot
+            move.product_uom_qty = quantity
+        picking_receipt = picking_form.save()
+        picking_receipt.action_confirm()
+        mo = self.env['mrp.production'].search([('bom_id', '=', self.bom_tracked.id)])
+
+        location = mo.move_raw_ids[0].location_id
+        Quant = self.env['stock.quant']
+        Quant._update_available_quantity(self.comp2, location, quantity)
+        for index in range(quantity):
+            serial = self.env['stock.production.lot'].create({
+                'name': 'sn%s' % index,
+                'product_id': self.comp1_sn.id,
+                'company_id': self.env.user.company_id.id,
+            })
+            Quant._update_available_quantity(self.comp1_sn, location, 1, lot_id=serial)
+        mo.action_assign()
+        finished_lot = self.env['stock.production.lot'].create({
+            'name': 'lot1',
+            'product_id': self.finished_lot.id,
+            'company_id': self.env.user.company_id.id,
+        })
+        return mo, finished_lot
+
+    def test_record_partial_reserved_line(self):
+        """ Consuming a part of a reserved move line splits it into a done
+        line, linked to the finished lot, and a line keeping the rest of the
+        reservation.
+        """
+        mo, finished_lot = self._create_reserved_production(5)
+        comp2_move = mo.move_raw_ids.filtered(lambda move: move.product_id == self.comp2)
+        self.assertEqual(len(comp2_move.move_line_ids), 1)
+
+        recorder = ProductionRecorder(mo, 2, mo.product_uom_id, finished_lot=finished_lot)
+        recorder.generate_lines()
+        recorder.record()
+
+        done_lines = comp2_move.move_line_ids.filtered('qty_done')
+        reserved_lines = comp2_move.move_line_ids - done_lines
+        self.assertEqual(done_lines.product_uom_qty, 2)
+        self.assertEqual(done_lines.qty_done, 2)
+        self.assertEqual(done_lines.lot_produced_ids, finished_lot)
+        self.assertEqual(reserved_lines.product_uom_qty, 3)
+        self.assertFalse(reserved_lines.lot_produced_ids)
+        self.assertEqual(comp2_move.reserved_availability, 5)
+
+    def test_record_lines_splitting_same_move_line(self):
+        """ Several produce lines consuming the same reserved move line split
+        it once each, the second line reading the split queued by the first.
+        """
+        mo, finished_lot = self._create_reserved_production(5)
+        comp2_move = mo.move_raw_ids.filtered(lambda move: move.product_id == self.comp2)
+
+        recorder = ProductionRecorder(mo, 3, mo.product_uom_id, finished_lot=finished_lot)
+        raw_lines = recorder.generate_lines()[0]
+        comp2_line = next(line for line in raw_lines if line.product == self.comp2)
+        recorder.raw_lines.remove(comp2_line)
+        recorder.raw_lines += [
+            ProduceLine(comp2_move, self.comp2, comp2_line.product_uom, comp2_line.lot,
+                        qty_to_consume=quantity, qty_reserved=quantity, qty_done=quantity)
+            for quantity in (1, 2)
+        ]
+        recorder.record()
+
+        done_lines = comp2_move.move_line_ids.filtered('qty_done')
+        reserved_lines = comp2_move.move_line_ids - done_lines
+        self.assertEqual(sorted(done_lines.mapped('qty_done')), [1, 2])
+        self.assertEqual(sorted(done_lines.mapped('product_uom_qty')), [1, 2])
+        self.assertEqual(done_lines.mapped('lot_produced_ids'), finished_lot)
+        self.assertEqual(reserved_lines.product_uom_qty, 2)
+        self.assertEqual(comp2_move.reserved_availability, 5)
+
+    def test_record_serial_reused_in_queued_split(self):
+        """ A serial number consumed by a queued split cannot be consumed
+        again by another line of the same recording.
+        """
+        mo, finished_lot = self._create_reserved_production(2)
+        comp1_move = mo.move_raw_ids.filtered(lambda move: move.product_id == self.comp1_sn)
+
+        recorder = ProductionRecorder(mo, 2, mo.product_uom_id, finished_lot=finished_lot)
+        raw_lines = recorder.generate_lines()[0]
+        serial_lines = [line for line in raw_lines if line.product == self.comp1_sn]
+        self.assertEqual(len(serial_lines), 2)
+        # the first line only consumes a part of its move line, which is split
+        serial_lines[0].qty_done = 0.5
+        serial_lines[1].lot = serial_lines[0].lot
+        with self.assertRaises(UserError):
+            recorder.record()
+        # nothing was saved on the component move lines
+        self.assertFalse(any(comp1_move.move_line_ids.mapped('qty_done')))
+
+    def test_relabel_done_finished_lots(self):
+        """ Relabelling the done finished lines of a production adds the new
+        lot to its components and logs one message for the production.
+        """
+        mo, lot1 = self._create_reserved_production(2)
+        lot2, lot3 = self.env['stock.production.lot'].create([{
+            'name': name,
+            'product_id': self.finished_lot.id,
+            'company_id': self.env.user.company_id.id,
+        } for name in ('lot2', 'lot3')])
+        for lot in (lot1, lot2):
+            recorder = ProductionRecorder(mo, 1, mo.product_uom_id, finished_lot=lot)
+            recorder.generate_lines()
+            recorder.record()
+        mo.move_finished_ids._action_done()
+        finished_lines = mo.move_finished_ids.mapped('move_line_ids')
+        self.assertEqual(finished_lines.mapped('state'), ['done', 'done'])
+        component_lines = mo.move_raw_ids.mapped('move_line_ids').filtered('lot_produced_ids')
+        self.assertEqual(component_lines.mapped('lot_produced_ids'), lot1 | lot2)
+
+        message_count = len(mo.message_ids)
+        finished_lines.write({'lot_id': lot3.id})
+        self.assertEqual(len(mo.message_ids), message_count + 1)
+        for line in component_lines:
+            self.assertIn(lot3, line.lot_produced_ids)
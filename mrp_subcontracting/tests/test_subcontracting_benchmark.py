@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+""" Benchmark of the subcontracting flows, not run by default. To run it:
+
+    odoo-bin -d <db> -i mrp_subcontracting --stop-after-init \
+        --test-tags mrp_subcontracting_benchmark
+
+The size of the generated data is read from the environment:
+
+    MRP_SUBCONTRACTING_BENCHMARK_SUBCONTRACTORS  subcontractors (default 2)
+    MRP_SUBCONTRACTING_BENCHMARK_BOMS            subcontract BoMs (default 4)
+    MRP_SUBCONTRACTING_BENCHMARK_COMPONENTS      components per BoM (default 5)
+    MRP_SUBCONTRACTING_BENCHMARK_LINES           lines per receipt (default 10)
+    MRP_SUBCONTRACTING_BENCHMARK_OUTPUT          file to write the report to
+
+Every other BoM has a lot tracked component. The lines of a receipt cycle
+over the finished products, the lines sharing a product are merged when the
+receipt is confirmed. Each subcontractor gets a
+receipt of untracked products, confirmed, validated then returned, and a
+receipt of products with tracked components, confirmed then used to record
+the components of each line, with a lot for the tracked ones.
+
+The report gives, per stage, the wall time in seconds, the number of SQL
+queries and the peak of memory allocated by Python in bytes. It is logged
+as JSON and written to MRP_SUBCONTRACTING_BENCHMARK_OUTPUT if set. Memory is
+traced with tracemalloc, which slows down the stages: compare wall times
+between runs of the benchmark only.
+"""
+
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from odoo.tests import Form, tagged
+from odoo.addons.mrp_subcontracting.tests.common import TestMrpSubcontractingCommon
+
+_logger = logging.getLogger(__name__)
+
+
+def _get_size(name, default):
+    return int(os.environ.get('MRP_SUBCONTRACTING_BENCHMARK_%s' % name, default))
+
+
+@tagged('-standard', 'mrp_subcontracting_benchmark', 'post_install', '-at_install')
+class TestSubcontractingBenchmark(TestMrpSubcontractingCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubcontractingBenchmark, cls).setUpClass()
+        cls.subcontractor_count = _get_size('SUBCONTRACTORS', 2)
+        cls.bom_count = _get_size('BOMS', 4)
+        cls.component_count = _get_size('COMPONENTS', 5)
+        cls.line_count = _get_size('LINES', 10)
+
+        category = cls.env.ref('product.product_category_all')
+        main_partner = cls.env['res.partner'].create({'name': 'benchmark main partner'})
+        cls.subcontractors = cls.env['res.partner'].create([{
+            'name': 'benchmark subcontractor %s' % index,
+            'parent_id': main_partner.id,
+            'company_id': cls.env.ref('base.main_company').id,
+        } for index in range(cls.subcontractor_count)])
+
+        cls.untracked_products = cls.env['product.product']
+        cls.tracked_products = cls.env['product.product']
+        cls.lot_per_component = {}
+        for bom_index in range(cls.bom_count):
+            tracked = bool(bom_index % 2)
+            components = cls.env['product.product'].create([{
+                'name': 'benchmark component %s-%s' % (bom_index, index),
+                'type': 'product',
+                'categ_id': category.id,
+                'tracking': 'lot' if tracked and not index else 'none',
+            } for index in range(cls.component_count)])
+            for component in components.filtered(lambda product: product.tracking != 'none'):
+                cls.lot_per_component[component] = cls.env['stock.production.lot'].create({
+                    'name': 'benchmark lot %s' % component.name,
+                    'product_id': component.id,
+                    'company_id': cls.env.ref('base.main_company').id,
+                })
+            finished = cls.env['product.product'].create({
+                'name': 'benchmark finished %s' % bom_index,
+                'type': 'product',
+                'categ_id': category.id,
+            })
+            cls.env['mrp.bom'].create({
+                'type': 'subcontract',
+                'product_tmpl_id': finished.product_tmpl_id.id,
+                'subcontractor_ids': [(6, 0, cls.subcontractors.ids)],
+                'bom_line_ids': [(0, 0, {
+                    'product_id': component.id,
+                    'product_qty': 1,
+                }) for component in components],
+            })
+            if tracked:
+                cls.tracked_products |= finished
+            else:
+                cls.untracked_products |= finished
+
+    def setUp(self):
+        super(TestSubcontractingBenchmark, self).setUp()
+        self.report = {
+            'subcontractors': self.subcontractor_count,
+            'boms': self.bom_count,
+            'components': self.component_count,
+            'lines': self.line_count,
+            'stages': {},
+        }
+
+    @contextmanager
+    def _measure(self, stage):
+        """ Add the wall time, query count and memory peak of the block to the
+        report, under the given stage.
+        """
+        self.env.cache.invalidate()
+        query_count = self.cr.sql_log_count
+        tracemalloc.start()
+        start = time.time()
+        try:
+            yield
+        finally:
+            wall_time = time.time() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.report['stages'][stage] = {
+                'wall_time': round(wall_time, 6),
+                'query_count': self.cr.sql_log_count - query_count,
+                'peak_memory': peak_memory,
+            }
+
+    def _create_receipt(self, subcontractor, products):
+        picking_type = self.env.ref('stock.picking_type_in')
+        location = self.env.ref('stock.stock_location_suppliers')
+        location_dest = picking_type.default_location_dest_id
+        return self.env['stock.picking'].create({
+            'picking_type_id': picking_type.id,
+            'partner_id': subcontractor.id,
+            'location_id': location.id,
+            'location_dest_id': location_dest.id,
+            'move_lines': [(0, 0, {
+                'name': products[index % len(products)].name,
+                'product_id': products[index % len(products)].id,
+                'product_uom': products[index % len(products)].uom_id.id,
+                'product_uom_qty': 1 + index % 3,
+                'location_id': location.id,
+                'location_dest_id': location_dest.id,
+            }) for index in range(self.line_count)],
+        })
+
+    def _write_report(self):
+        report = json.dumps(self.report, indent=4, sort_keys=True)
+        _logger.info('mrp_subcontracting benchmark:\n%s', report)
+        output = os.environ.get('MRP_SUBCONTRACTING_BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'w') as report_file:
+                report_file.write(report)
+
+    def test_benchmark(self):
+        untracked_receipts = self.env['stock.picking']
+        tracked_receipts = self.env['stock.picking']
+        for subcontractor in self.subcontractors:
+            untracked_receipts |= self._create_receipt(subcontractor, self.untracked_products)
+            if self.tracked_products:
+                tracked_receipts |= self._create_receipt(subcontractor, self.tracked_products)
+        receipts = untracked_receipts | tracked_receipts
+
+        with self._measure('_action_confirm'):
+            receipts.mapped('move_lines')._action_confirm()
+        receipts.action_assign()
+        self.assertEqual(
+            len(receipts.mapped('move_lines.subcontract_production_id')),
+            len(receipts.mapped('move_lines')),
+        )
+
+        with self._measure('action_record_components'):
+            for move in tracked_receipts.mapped('move_lines'):
+                production = move.subcontract_production_id
+                action = move._action_record_components()
+                produce = self.env['mrp.product.produce'].with_context(
+                    action['context'], active_id=production.id).create({
+                        'production_id': production.id,
+                        'subcontract_move_id': move.id,
+                        'product_qty': move.product_uom_qty,
+                        'product_uom_id': move.product_uom.id,
+                    })
+                produce._generate_produce_lines()
+                for line in produce.raw_workorder_line_ids:
+                    if line.product_id in self.lot_per_component:
+                        line.lot_id = self.lot_per_component[line.product_id]
+                produce._record_production()
+        raw_moves = tracked_receipts.mapped('move_lines.subcontract_production_id.move_raw_ids')
+        self.assertTrue(all(raw_moves.mapped('quantity_done')))
+
+        for move in untracked_receipts.mapped('move_lines'):
+            move.quantity_done = move.product_uom_qty
+        with self._measure('action_done'):
+            untracked_receipts.action_done()
+        self.assertTrue(all(
+            production.state == 'done'
+            for production in untracked_receipts.mapped('move_lines.subcontract_production_id')
+        ))
+
+        with self._measure('return'):
+            for receipt in untracked_receipts:
+                return_form = Form(self.env['stock.return.picking'].with_context(
+                    active_ids=receipt.ids, active_id=receipt.id, active_model='stock.picking'))
+                return_form.save().create_returns()
+
+        self._write_report()